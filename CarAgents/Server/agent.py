@@ -1,93 +1,116 @@
 from mesa import Agent
-# from graph import a_star_search
+from graph import repair_path
 from bfs3 import bfs_shortest_path
+from map_compiler import ROAD, TRAFFIC_LIGHT, DESTINATION
+from logs import get_logger
+
+log = get_logger("agent")
 
 
 class Car_Agent(Agent):
     """
     Car Agent: Use a* to find the shortest (and fastest) path to a given random destination.
+    unique_id is a small integer, also used by the binary frame format.
     """
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
         self.in_traffic = False
         self.destination = None
-        self.path = []
+        # Route as a tuple of cells, shared with every car that got it from the route cache, and the index
+        # of the car's cell in it
+        self.path = ()
+        self.cursor = 0
         self.at_destination = False
 
+    def follow(self, path):
+        self.path = tuple(path)
+        self.cursor = 0
+
+    def arrive(self):
+        self.at_destination = True
+        # Call destination's method to increment the number of cars that have reached it
+        self.destination.reached_destination()
+        log.debug("These arrivals %s", self.destination.arrivals)
+        self.model.schedule.remove(self)
+        # Stays on its destination for this step so clients see it arrive, the model retires it next step
+        self.model.arrived.append(self)
+
     def move(self):
         """ 
         Determines if the agent can move in the direction that was chosen
         """
         if len(self.path) == 0:
             # print(f">>> Agent {self.unique_id} is recalculating route")
-            self.path = self.calculate_route()
+            self.follow(self.calculate_route())
             pass
         else:
             # print(f"> Agent {self.unique_id} has destination: {self.destination.pos}")
-            # print(f"> Agent {self.unique_id} has path: {self.path[0:3]}...{self.path[-4:-1]}")
-            # print(f"> Agent {self.unique_id} at {self.pos} has next move: {self.path[1]}")
+            # print(f"> Agent {self.unique_id} at {self.pos} has next move: {self.path[self.cursor + 1]}")
 
             # Get neighbors of current cell
-            neighbors = self.model.coord_graph[str(self.pos)]
+            neighbors = self.model.road_graph.neighbor_positions(self.pos)
 
             # Check if goal position has been reached
             if self.pos != self.destination.pos:
-                if self.check_pos_contents(self.path[1]) == "Go":
-                    # If the first cell of the BFS list is evaluated as a valid move, move to that cell
-                    # print(f"> Agent {self.unique_id} is moving to: {self.path[1]}")
-                    self.model.grid.move_agent(self, self.path[1])
+                next_cell = self.path[self.cursor + 1]
+                if self.check_pos_contents(next_cell) == "Go":
+                    # If the next cell of the route is evaluated as a valid move, move to that cell
+                    # print(f"> Agent {self.unique_id} is moving to: {next_cell}")
+                    self.model.grid.move_agent(self, next_cell)
+                    # Advance along the route
+                    self.cursor += 1
                     if self.pos == self.destination.pos:
-                        self.at_destination = True
-                        self.destination.reached_destination()
-                        print(f"These arrivals {self.destination.arrivals}")
-                        self.model.schedule.remove(self)
-                    # Remove the first cell from the BFS list
-                    self.path.pop(0)
+                        self.arrive()
                 else:
                     # Else, Iterate Neighbors and pick first that is valid, also recalculate route from current position
                     for neighbor in neighbors:
-                        if self.check_pos_contents(neighbor) == "Go": 
+                        contents = self.check_pos_contents(neighbor)
+                        if contents == "Go":
                             # print(f"> Agent {self.unique_id} is moving to: {neighbor}")
                             self.in_traffic = False
                             self.model.grid.move_agent(self, neighbor)
                             if self.pos == self.destination.pos:
-                                self.at_destination = True
-                                self.destination.reached_destination()
-                                print(f"These arrivals {self.destination.arrivals}")
-                                self.model.schedule.remove(self)
+                                self.arrive()
                             else:
-                                self.path = self.calculate_route()
-                            # print(f">>> Agent {self.unique_id} is recalculating route")
+                                self.follow(self.repair_route())
+                            # print(f">>> Agent {self.unique_id} is repairing route")
                             break
-                        elif self.check_pos_contents(neighbor) == "Switch":
+                        elif contents == "Switch":
                             # Evaluate next neighbor
                             continue
-                        elif self.check_pos_contents(neighbor) == "Wait":
-                            # If it has to wait, break from loop and evaluate original BFS cell in the next iteration
+                        elif contents == "Wait":
+                            # If it has to wait, break from loop and evaluate the route's next cell in the next iteration
                             self.in_traffic = True
+                            self.model.metrics.count("blocked_moves")
                             break
+                    else:
+                        # Every neighbor is taken
+                        self.model.metrics.count("blocked_moves")
             else:
-                self.at_destination = True
-                # Call destination's method to increment the number of cars that have reached it
-                self.destination.reached_destination()
-                print(f"These arrivals {self.destination.arrivals}")
-                self.model.schedule.remove(self)
+                self.arrive()
 
     def check_pos_contents(self, pos):
-        cell_contents = self.model.grid.get_cell_list_contents(pos)[0]
-        
+        # Read the cell's static type, light state and car count from the model's layers
+        layers = self.model.layers
+        cell = pos[1] * layers.width + pos[0]
+        cell_type = layers.cell_type[cell]
+
+        # Destinations take any number of cars, but only the cars heading there: a car can't drive out of one
+        if cell_type == DESTINATION:
+            return "Go" if pos == self.destination.pos else "Switch"
+
         # Check if the desired cell has the same direction as the current cell in order to chage lanes
-        if isinstance(cell_contents, Road_Agent) or isinstance(cell_contents, Destination_Agent):  
-            if len(self.model.grid.get_cell_list_contents(pos)) < 2 or isinstance(cell_contents, Destination_Agent):
+        if cell_type == ROAD:
+            if layers.cars[cell] == 0:
                 return "Go"
             else:
                 return "Switch"
 
         # Else check if the next cell is a traffic light on green or red
-        elif isinstance(cell_contents, Traffic_Light_Agent): 
-            if cell_contents.state == True and len(self.model.grid.get_cell_list_contents(pos)) < 2:
+        elif cell_type == TRAFFIC_LIGHT:
+            if layers.light[cell] and layers.cars[cell] == 0:
                 return "Go"
-            elif cell_contents.state == False:
+            elif not layers.light[cell]:
                 self.in_traffic = True
                 # print(">>> Waiting")
                 return "Wait"
@@ -97,26 +120,45 @@ class Car_Agent(Agent):
 
 
     def calculate_route(self):
-        # Generate path by calling the A* search algorithm with the current position and a randomly chosen destination
+        # Generate path by following the destination's precomputed next-hop table from the current position
         # print(f"> Agent {self.unique_id} current position: {self.pos}")
         # print(f"> Agent {self.unique_id} current destination: {self.destination.pos}")
-            
-        path_dict = bfs_shortest_path(self.model.coord_graph, self.pos, self.destination.pos)
-        # print(f"> Agent {self.unique_id} path_dict: {path_dict}")
-        # Position list in the order in which A* generated the path dictionary
-        path_list = []
-
-        if path_dict != None:
-            for coord in path_dict:
-                if coord not in path_list:
-                    path_list.append(coord)
-        else:
+
+        # Cars leaving the same cell for the same destination share one route
+        cached_route = self.model.route_cache.get(self.pos, self.destination.pos)
+        if cached_route != None:
+            self.model.metrics.count("route_cache_hits")
+            return cached_route
+
+        self.model.metrics.count("route_recomputes")
+        with self.model.metrics.time("routing"):
+            if self.destination.pos in self.model.distance_fields:
+                path_list = self.model.route_to(self.pos, self.destination.pos)
+            else:
+                # Fall back to a BFS search if the destination has no table
+                path_list = bfs_shortest_path(self.model.road_graph, self.pos, self.destination.pos)
+        # print(f"> Agent {self.unique_id} path_list: {path_list}")
+
+        if path_list == None:
             # print(">>> Path not found")
-            pass
-        # print(f"> Path list: {path_list}")
+            path_list = []
+
+        return self.model.route_cache.put(self.pos, self.destination.pos, path_list)
 
+    def repair_route(self):
+        # Splice a short detour from the current position back onto the rest of the path, instead of a full new search
+        road_graph = self.model.road_graph
+        old_path = [road_graph.node(pos) for pos in self.path[self.cursor + 1:]]
 
-        return path_list
+        if len(old_path) > 0 and old_path[-1] == road_graph.node(self.destination.pos):
+            self.model.metrics.count("route_repairs")
+            with self.model.metrics.time("route_repair"):
+                new_path = repair_path(self.model.planner, road_graph.node(self.pos), old_path)
+            if new_path != None:
+                return [road_graph.position(node) for node in new_path]
+
+        # The old path couldn't be rejoined nearby, plan again from scratch
+        return self.calculate_route()
         
     def step(self):
         """ 
@@ -128,11 +170,25 @@ class Traffic_Light_Agent(Agent):
     """
     Traffic Light Agent. Interpolates between two states, green and red.
     """
+    # Switched by the model's SignalController, its own step does nothing
+    passive = True
+
     def __init__(self, unique_id, model, state = False, timeToChange = 10):
         super().__init__(unique_id, model)
-        self.state = state
+        self._state = state
         self.timeToChange = timeToChange
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        # Mirror the state into the model's light layer once the light is on the grid
+        self._state = state
+        if self.pos is not None:
+            self.model.layers.light[self.model.layers.index(self.pos)] = state
+
     def step(self):
         pass
 
@@ -145,7 +201,7 @@ class Destination_Agent(Agent):
         self.arrivals = 0
 
     def reached_destination(self):
-        print(f"A car has arrived at {self.unique_id}")
+        log.debug("A car has arrived at %s", self.unique_id)
         self.arrivals += 1
 
     def step(self):
@@ -181,9 +237,9 @@ class Car_Spawner_Agent(Agent):
         self.spawned = 0
     
     def spawn_car(self):
-        if len(self.model.grid.get_cell_list_contents(self.pos)) < 2:
+        if self.model.layers.cars[self.model.layers.index(self.pos)] == 0:
             self.spawned += 1
-            car = Car_Agent(f"c_{self.unique_id}{self.spawned+1000}", self.model)
+            car = Car_Agent(self.model.next_car_number(), self.model)
             self.model.grid.place_agent(car, self.pos)
             self.model.schedule.add(car)
 
@@ -0,0 +1,25 @@
+class AgentIndex:
+    """
+    Per-model registry of agents by their exact type, so the model can iterate all the agents of one type
+    (e.g. every spawner or every traffic light) without scanning the grid.
+    """
+    def __init__(self):
+        self.by_type = {}
+
+    def add(self, agent):
+        self.of_type(type(agent))[agent.unique_id] = agent
+
+    def remove(self, agent):
+        self.of_type(type(agent)).pop(agent.unique_id, None)
+
+    def of_type(self, agent_type):
+        """
+        Returns the live {unique_id: agent} dictionary of agent_type, in insertion order.
+        """
+        agents = self.by_type.get(agent_type)
+        if agents is None:
+            agents = self.by_type[agent_type] = {}
+        return agents
+
+    def count(self, agent_type):
+        return len(self.by_type.get(agent_type, ()))
@@ -0,0 +1,224 @@
+"""
+Headless parameter sweeps of RandomModel, without the Flask or Mesa servers.
+Every combination of map, signal mode, spawn interval, light period and seed is one independent run, and runs are spread
+over a process pool. Results go to a CSV file, or Parquet if the output ends in .parquet and pandas is
+installed.
+
+    python batch.py --maps Assets/Data/2022_base.txt --spawn-intervals 2 4 --light-periods 5 10 20 \\
+        --seeds 10 --steps 500 --output results.csv
+
+With --warmup every combination is simulated once up to that step and its replications branch from a
+checkpoint of that state, each with its own seed, instead of repeating the warm-up. --checkpoint branches
+every run from a checkpoint file instead, e.g. one downloaded from the server's /checkpoint.
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from model import RandomModel
+from checkpoint import read_checkpoint
+from sharding import ShardedModel
+from signals import MODES as SIGNAL_MODES, LEGACY
+
+COLUMNS = ["map", "engine", "signals", "shards", "spawn_interval", "light_period", "seed", "warmup", "steps",
+           "spawned", "arrivals", "in_transit", "spawn_attempts", "jammed", "jam_rate", "throughput", "seconds"]
+
+
+def sweep(maps, spawn_intervals, light_periods, seeds, engine="agents", signals=(LEGACY,), shards=1):
+    """
+    One run configuration per combination of the given values. With shards > 1 every run is a ShardedModel
+    using that many worker processes of its own.
+    """
+    return [{"map": map_path, "engine": engine if shards <= 1 else "batched", "signals": mode, "shards": shards, "spawn_interval": spawn_interval, "light_period": light_period, "seed": seed}
+            for map_path, mode, spawn_interval, light_period, seed in itertools.product(maps, signals, spawn_intervals, light_periods, seeds)]
+
+
+def run_replication(config, steps):
+    """
+    Runs one configuration for steps steps and returns its row of results.
+    Throughput is arrivals per step, jam rate the share of spawn attempts that found the spawner blocked.
+    Runs branching from a checkpoint only count what happened after it, in_transit is the cars left on the
+    map at the end.
+    The row ends with the model's metrics summary: event counts and time spent in each phase.
+    """
+    started = time.perf_counter()
+    config = dict(config)
+    checkpoint = config.pop("checkpoint", None)
+    model = build_model(config, checkpoint)
+    spawned_before, arrivals_before = totals(model)
+    attempts_before, jammed_before = model.spawn_attempts, model.spawns_jammed
+    try:
+        for _ in range(steps):
+            model.step()
+    finally:
+        model.close()
+
+    spawned, arrivals = totals(model)
+    spawn_attempts = model.spawn_attempts - attempts_before
+    jammed = model.spawns_jammed - jammed_before
+    return dict(config,
+                steps=steps,
+                spawned=spawned - spawned_before,
+                arrivals=arrivals - arrivals_before,
+                in_transit=spawned - arrivals,
+                spawn_attempts=spawn_attempts,
+                jammed=jammed,
+                jam_rate=jammed / spawn_attempts if spawn_attempts else 0.0,
+                throughput=(arrivals - arrivals_before) / steps if steps else 0.0,
+                seconds=time.perf_counter() - started,
+                **model.metrics.summary())
+
+
+def build_model(config, checkpoint=None):
+    if checkpoint is not None:
+        # Same state as the checkpoint, but a random stream and parameters of this run's own
+        model = RandomModel.from_checkpoint(checkpoint)
+        model.reseed(config["seed"])
+        model.spawn_interval = config["spawn_interval"]
+        model.light_period = config["light_period"]
+        return model
+    options = dict(seed=config["seed"], spawn_interval=config["spawn_interval"], light_period=config["light_period"],
+                   signals=config.get("signals", LEGACY))
+    if config.get("shards", 1) > 1:
+        return ShardedModel(config["map"], config["shards"], **options)
+    return RandomModel(config["map"], config["engine"], **options)
+
+
+def totals(model):
+    # Cars spawned and arrived so far
+    return (sum(spawner.spawned for spawner in model.spawners.values()),
+            sum(destination.arrivals for destination in model.destinations.values()))
+
+
+def warm_up(config, steps):
+    """
+    Checkpoint of config's model after steps steps.
+    """
+    model = build_model(config)
+    for _ in range(steps):
+        model.step()
+    return model.checkpoint()
+
+
+def add_warm_ups(configs, steps, workers=None):
+    """
+    Warms up every combination once, with the seed of its first replication, and points its replications
+    at the checkpoint.
+    """
+    groups = {}
+    for config in configs:
+        groups.setdefault(tuple((name, value) for name, value in config.items() if name != "seed"), []).append(config)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(warm_up, group[0], steps): group for group in groups.values()}
+        for done, future in enumerate(as_completed(futures), 1):
+            checkpoint = future.result()
+            for config in futures[future]:
+                config.update(checkpoint=checkpoint, warmup=steps)
+            print(f"{done}/{len(groups)} warm-ups done")
+
+
+def run_batch(configs, steps, workers=None):
+    """
+    Runs every configuration in a process pool and returns the rows in the order of configs.
+    Args:
+        configs: Run configurations, see sweep()
+        steps: Steps per run
+        workers: Worker processes, None for one per CPU
+    """
+    rows = [None] * len(configs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_replication, config, steps): i for i, config in enumerate(configs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            rows[futures[future]] = future.result()
+            print(f"{done}/{len(configs)} runs done")
+    return rows
+
+
+def write_results(rows, path):
+    # Fixed columns first, then the metrics, which depend on the engine and on what happened in the run
+    columns = COLUMNS + sorted({name for row in rows for name in row} - set(COLUMNS))
+    if path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise SystemExit("Writing Parquet needs pandas and pyarrow, use a .csv output instead")
+        pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return
+
+    with open(path, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames=columns, restval=0)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_summary(rows):
+    """
+    Time per phase across all runs, slowest first.
+    """
+    phases = {}
+    for row in rows:
+        for name, value in row.items():
+            if name.endswith("_mean_seconds"):
+                continue
+            if name.endswith("_seconds") and name != "seconds":
+                phases[name[:-len("_seconds")]] = phases.get(name[:-len("_seconds")], 0.0) + value
+    total = sum(row["seconds"] for row in rows)
+    print(f"Total run time: {total:.2f}s")
+    for phase, seconds in sorted(phases.items(), key=lambda item: -item[1]):
+        print(f"  {phase:<16} {seconds:8.2f}s  {seconds / total:6.1%}" if total else f"  {phase:<16} {seconds:8.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run RandomModel parameter sweeps in parallel.")
+    parser.add_argument("--maps", nargs="+", default=["Assets/Data/2022_base.txt"],
+                        help="Map files, relative to the TrafficVisualization project")
+    parser.add_argument("--engine", default="agents", choices=["agents", "batched"])
+    parser.add_argument("--signals", nargs="+", default=[LEGACY], choices=SIGNAL_MODES,
+                        help="Traffic light controllers to compare")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Worker processes per run, each simulating one tile of the map (batched engine only)")
+    parser.add_argument("--spawn-intervals", nargs="+", type=int, default=[2])
+    parser.add_argument("--light-periods", nargs="+", type=int, default=[10])
+    parser.add_argument("--seeds", type=int, default=1, help="Replications per combination, seeded 0..n-1")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=0, help="Steps simulated once per combination before branching")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint every run branches from, its map, engine and signal mode replace --maps, --engine and --signals")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="results.csv")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    if args.shards > 1 and (args.warmup or args.checkpoint):
+        raise SystemExit("Sharded runs can't be checkpointed, drop --warmup and --checkpoint or --shards")
+
+    checkpoint = None
+    if args.checkpoint:
+        with open(args.checkpoint, "rb") as checkpoint_file:
+            checkpoint = checkpoint_file.read()
+        try:
+            header, _ = read_checkpoint(checkpoint)
+        except ValueError as error:
+            raise SystemExit(f"{args.checkpoint}: {error}")
+
+    # Map and dictionary paths are relative to this directory, same as when running the servers
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if checkpoint is not None:
+        configs = sweep([header["map_path"]], args.spawn_intervals, args.light_periods, range(args.seeds),
+                        header["engine"], [header["signals"]])
+        for config in configs:
+            config.update(checkpoint=checkpoint, warmup=header["steps"])
+    else:
+        configs = sweep(args.maps, args.spawn_intervals, args.light_periods, range(args.seeds), args.engine, args.signals, args.shards)
+        if args.warmup > 0:
+            add_warm_ups(configs, args.warmup, args.workers)
+    rows = run_batch(configs, args.steps, args.workers)
+    write_results(rows, output)
+    print(f"Wrote {len(rows)} runs to {output}")
+    print_summary(rows)
+
+
+if __name__ == '__main__':
+    main()
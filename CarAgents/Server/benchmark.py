@@ -0,0 +1,252 @@
+"""
+Scaling benchmarks on synthetic cities (see city_generator.py) for the CarAgents model, and on empty boards
+for the PackageRobots model. Every case runs in a fresh process so its peak RSS is its own.
+Results are written as JSON with the commit they were measured on; --compare prints the change against an
+older file.
+
+    python benchmark.py --sizes 24 48 96 192 --steps 200 --output bench.json
+    python benchmark.py --sizes 24 48 96 192 --compare bench.json
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+ROBOTS_DIR = os.path.join(SERVER_DIR, "..", "..", "PackageRobots", "Server")
+VISUALIZATION_DIR = os.path.join(SERVER_DIR, "..", "TrafficVisualization")
+# Route queries timed per map
+ROUTE_SAMPLES = 200
+# Times the step rate is measured during a run, to see it against the number of cars
+CHECKPOINTS = 5
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def latency(function, arguments):
+    """
+    Mean and 95th percentile of function(*args) over arguments, in microseconds.
+    """
+    times = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        times.append((time.perf_counter() - started) * 1e6)
+    times.sort()
+    if not times:
+        return {"mean_us": None, "p95_us": None}
+    return {"mean_us": sum(times) / len(times), "p95_us": times[int(len(times) * 0.95) - 1 if len(times) > 1 else 0]}
+
+
+def run_steps(model, steps, active_cars):
+    """
+    Steps the model in CHECKPOINTS chunks, returning the step rate of each chunk and the cars driving at its end.
+    """
+    checkpoints = []
+    chunk = max(1, steps // CHECKPOINTS)
+    done = 0
+    while done < steps and model.running:
+        count = min(chunk, steps - done)
+        started = time.perf_counter()
+        for _ in range(count):
+            model.step()
+        elapsed = time.perf_counter() - started
+        done += count
+        checkpoints.append({"step": done, "cars": active_cars(model), "steps_per_second": count / elapsed if elapsed else None})
+    return checkpoints
+
+
+def mean_rate(checkpoints):
+    # Steps per second over the whole run
+    seconds = sum((c["step"] - (checkpoints[i - 1]["step"] if i else 0)) / c["steps_per_second"]
+                  for i, c in enumerate(checkpoints) if c["steps_per_second"])
+    return checkpoints[-1]["step"] / seconds if checkpoints and seconds else None
+
+
+def bench_cars(size, engine, steps, seed):
+    os.chdir(SERVER_DIR)
+    sys.path.insert(0, SERVER_DIR)
+    from city_generator import write_city, LANES
+    from map_compiler import read_map, cell_layers, compile_road_graph, compile_distance_fields
+    from map_cache import load_compiled_map
+    from bfs3 import bfs_shortest_path
+    from model import RandomModel
+
+    dataDictionary = json.load(open("mapDictionary.txt"))
+    with tempfile.TemporaryDirectory(dir=VISUALIZATION_DIR) as directory:
+        path = os.path.join(directory, f"city_{size}.txt")
+        # Blocks of about 6 cells, stretched so the map comes out exactly size x size
+        blocks = max(2, (size - LANES) // 8)
+        block = (size - LANES) // blocks - LANES
+        width, height = write_city(path, size, size, block=block, seed=seed, spawners=max(4, size // 12))
+
+        started = time.perf_counter()
+        cell_types, directions = cell_layers(read_map(path), dataDictionary)
+        road_graph = compile_road_graph(cell_types, directions)
+        graph_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        compile_distance_fields(road_graph, cell_types)
+        distance_field_seconds = time.perf_counter() - started
+
+        # Compile into the map cache first, so init is measured the way a server sees it after the first run
+        load_compiled_map(path, dataDictionary)
+        started = time.perf_counter()
+        model = RandomModel(os.path.relpath(path, VISUALIZATION_DIR), engine, seed=seed)
+        init_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed)
+    roads = [road_graph.position(node) for node in range(road_graph.width * road_graph.height) if road_graph.neighbors(node)]
+    destinations = list(model.distance_fields)
+    pairs = [(rng.choice(roads), rng.choice(destinations)) for _ in range(ROUTE_SAMPLES)] if destinations else []
+
+    def active_cars(model):
+        spawned = sum(spawner.spawned for spawner in model.spawners.values())
+        return spawned - sum(destination.arrivals for destination in model.destinations.values())
+
+    checkpoints = run_steps(model, steps, active_cars)
+    return {
+        "model": "cars",
+        "engine": engine,
+        "size": size,
+        "width": width,
+        "height": height,
+        "destinations": len(destinations),
+        "spawners": len(model.spawners),
+        "graph_build_seconds": graph_seconds,
+        "distance_field_seconds": distance_field_seconds,
+        "init_seconds": init_seconds,
+        "route_table": latency(model.route_to, pairs),
+        "route_bfs": latency(lambda start, goal: bfs_shortest_path(model.road_graph, start, goal), pairs[:ROUTE_SAMPLES // 10]),
+        "steps": checkpoints,
+        "steps_per_second": mean_rate(checkpoints),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_robots(size, steps, seed):
+    os.chdir(ROBOTS_DIR)
+    sys.path.insert(0, ROBOTS_DIR)
+    from RandomAgents import RandomModel
+
+    robots = max(1, size // 2)
+    packages = size
+    # Depots hold 5 packages each, enough of them for every package
+    depots = packages // 5 + 1
+    started = time.perf_counter()
+    model = RandomModel(robots, packages, depots, size, size)
+    # The constructor takes no seed, so at least the steps are repeatable
+    model.reset_randomizer(seed)
+    init_seconds = time.perf_counter() - started
+
+    checkpoints = run_steps(model, steps, lambda model: robots)
+    return {
+        "model": "robots",
+        "size": size,
+        "width": size,
+        "height": size,
+        "robots": robots,
+        "packages": packages,
+        "init_seconds": init_seconds,
+        "steps": checkpoints,
+        "steps_per_second": mean_rate(checkpoints),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_case(case):
+    """
+    Runs one case in the calling process, returning its results or the error that stopped it.
+    """
+    kind, size, engine, steps, seed = case
+    try:
+        if kind == "cars":
+            return bench_cars(size, engine, steps, seed)
+        return bench_robots(size, steps, seed)
+    except Exception as error:
+        return {"model": kind, "engine": engine, "size": size, "error": f"{type(error).__name__}: {error}"}
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return (result["model"], result.get("engine"), result["size"])
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {case_key(result): result for result in json.load(baseline_file)["results"]}
+    print(f"Against {baseline_path}:")
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None or "error" in result or "error" in old:
+            continue
+        changes = []
+        for metric in ["steps_per_second", "init_seconds", "peak_rss_mb"]:
+            if result.get(metric) and old.get(metric):
+                changes.append(f"{metric} {result[metric] / old[metric] - 1:+.1%}")
+        print(f"  {result['model']:<6} {result.get('engine') or '':<8} {result['size']:>5}  " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CarAgents and PackageRobots models against map size.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[24, 48, 96, 192])
+    parser.add_argument("--engines", nargs="+", default=["agents", "batched"], choices=["agents", "batched"])
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-robots", action="store_true")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="Earlier results to compare against")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    cases = [("cars", size, engine, args.steps, args.seed) for size in args.sizes for engine in args.engines]
+    if not args.skip_robots:
+        cases += [("robots", size, None, args.steps, args.seed) for size in args.sizes]
+
+    results = []
+    # One process per case, so peak RSS and module state don't leak from one case into the next
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        for case, result in zip(cases, executor.map(run_case, cases)):
+            results.append(result)
+            if "error" in result:
+                print(f"{case[0]:<6} {case[2] or '':<8} {case[1]:>5}  failed: {result['error']}")
+            else:
+                print(f"{case[0]:<6} {case[2] or '':<8} {case[1]:>5}  init {result['init_seconds']:.2f}s  "
+                      f"{result['steps_per_second'] or 0:.1f} steps/s  {result['peak_rss_mb']:.0f} MB")
+
+    report = {
+        "commit": commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "steps": args.steps,
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Wrote {len(results)} results to {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
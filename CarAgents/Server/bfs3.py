@@ -1,39 +1,69 @@
 # Based on "How to Implement Breadth-First Search in Python", Est. MARCH 18, 2017 ~ VALERIO VELARDO
 # https://pythoninwonderland.wordpress.com/2017/03/18/how-to-implement-breadth-first-search-in-python/
 
-# finds shortest path between 2 nodes of a graph using BFS
+from collections import deque
+
+import numpy as np
+
+from logs import get_logger
+
+log = get_logger("bfs")
+
+# finds shortest path between 2 cells of a RoadGraph using BFS
 def bfs_shortest_path(graph, start, goal):
-    # keep track of explored nodes
-    explored = []
-    # keep track of all the paths to be checked
-    queue = [[start]]
- 
     # return path if start is goal
     if start == goal:
-        print( "That was easy! Start = goal")
+        log.debug("That was easy! Start = goal")
         return None
- 
-    # keeps looping until all possible paths have been checked
+
+    start_node = graph.node(start)
+    goal_node = graph.node(goal)
+
+    # keep track of the node each explored node was reached from, instead of copying whole paths
+    parent = {start_node: None}
+    queue = deque([start_node])
+
+    # keeps looping until all reachable nodes have been checked
     while queue:
-        # pop the first path from the queue
-        path = queue.pop(0)
-        # get the last node from the path
-        node = path[-1]
-        if node not in explored:
-            neighbours = graph[str(node)]
-            # go through all neighbour nodes, construct a new path and
-            # push it into the queue
-            for neighbour in neighbours:
-                new_path = list(path)
-                new_path.append(neighbour)
-                queue.append(new_path)
-                # return path if neighbour is goal
-                if neighbour == goal:
-                    return new_path
- 
-            # mark node as explored
-            explored.append(node)
- 
+        node = queue.popleft()
+        for neighbour in graph.neighbors(node):
+            if neighbour not in parent:
+                parent[neighbour] = node
+                # rebuild the path by walking the parents back from the goal
+                if neighbour == goal_node:
+                    path = []
+                    while neighbour is not None:
+                        path.append(graph.position(neighbour))
+                        neighbour = parent[neighbour]
+                    path.reverse()
+                    return path
+                queue.append(neighbour)
+
     # in case there's no path between the 2 nodes
     # print("So sorry, but a connecting path doesn't exist :(")
-    return None
\ No newline at end of file
+    return None
+
+
+# builds a distance/next-hop table towards a single goal by running BFS backwards
+# from it, so every node of the graph knows its next move without searching again
+def bfs_distance_field(reverse_graph, goal):
+    size = reverse_graph.width * reverse_graph.height
+    goal_node = reverse_graph.node(goal)
+
+    # distance (in cells) from every node to the goal, -1 if unreachable
+    distance = [-1] * size
+    # next node to move to from every node, -1 if there is none
+    next_hop = [-1] * size
+    distance[goal_node] = 0
+    queue = deque([goal_node])
+
+    while queue:
+        node = queue.popleft()
+        # every predecessor of the node is one cell further away from the goal
+        for predecessor in reverse_graph.neighbors(node):
+            if distance[predecessor] == -1:
+                distance[predecessor] = distance[node] + 1
+                next_hop[predecessor] = node
+                queue.append(predecessor)
+
+    return np.array(distance, dtype=np.int32), np.array(next_hop, dtype=np.int32)
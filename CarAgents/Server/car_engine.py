@@ -0,0 +1,253 @@
+import numpy as np
+
+from map_compiler import ROAD, TRAFFIC_LIGHT, DESTINATION, MAX_CANDIDATES
+from agent import Destination_Agent
+
+# Result of checking a cell, same meaning as Car_Agent.check_pos_contents
+GO = 0
+SWITCH = 1
+WAIT = 2
+# Padding for cells without a next hop or candidate
+NO_CELL = 3
+
+# Per-car arrays, all indexed by the car's row
+CAR_ARRAYS = ["ids", "node", "destination", "in_traffic", "at_destination"]
+
+# Number of move/resolve passes per tick. The first pass only lets cars take their next hop, the second one
+# applies the full rules on the cells freed by the first, like agents activated later in the same tick would.
+# More passes let queues move further than RandomActivation does, which inflates throughput.
+MAX_PASSES = 2
+
+
+class BatchedCarEngine:
+    """
+    Struct-of-arrays car movement. Instead of one Car_Agent per car, the position, destination and flags
+    of every car live in NumPy arrays, and each tick is resolved in vectorized passes: propose the
+    next cell, resolve cells claimed by several cars with a seeded random priority, apply the moves.
+    Cars follow the same rules as Car_Agent.move(): take the next hop if it is free, otherwise take the
+    first free candidate cell (stopping at the first red light), and wait if there is none.
+    Args:
+        model: RandomModel with the compiled map, layers and agent index already built
+        capacity: Initial size of the car arrays, doubled whenever it runs out
+    """
+    def __init__(self, model, capacity=1024):
+        self.model = model
+        self.layers = model.layers
+        road_graph = model.road_graph
+
+        # Destinations in a fixed order, row i of the tables belongs to destination_agents[i]
+        self.destination_agents = list(model.index.of_type(Destination_Agent).values())
+        self.destination_rows = {agent.unique_id: i for i, agent in enumerate(self.destination_agents)}
+        self.destination_nodes = np.array([road_graph.node(agent.pos) for agent in self.destination_agents], dtype=np.int32)
+        self.next_hops = np.stack([model.distance_fields[agent.pos][1] for agent in self.destination_agents]) \
+            if self.destination_agents else np.empty((0, road_graph.width * road_graph.height), dtype=np.int32)
+
+        # Candidate cells of every node, in the order Car_Agent.move() tries them, -1 as padding
+        counts = np.diff(road_graph.indptr)
+        size = road_graph.width * road_graph.height
+        self.candidates = np.full((size, MAX_CANDIDATES), -1, dtype=np.int32)
+        slots = np.arange(len(road_graph.indices)) - np.repeat(road_graph.indptr[:-1], counts)
+        self.candidates[np.repeat(np.arange(size), counts), slots] = road_graph.indices
+
+        # Seeded from the model, so a seeded model always resolves conflicts the same way
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+
+        self.count = 0
+        self.next_id = 0
+        # Ids go next_id, next_id + id_stride, ..., so engines of a sharded model never hand out the same id
+        self.id_stride = 1
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.node = np.zeros(capacity, dtype=np.int32)
+        self.destination = np.zeros(capacity, dtype=np.int32)
+        self.in_traffic = np.zeros(capacity, dtype=bool)
+        self.at_destination = np.zeros(capacity, dtype=bool)
+
+    def grow(self):
+        for name in CAR_ARRAYS:
+            array = getattr(self, name)
+            grown = np.zeros(len(array) * 2, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def spawn(self, spawner, destination):
+        """
+        Adds a car on the spawner's cell heading to destination, unless the cell is taken.
+        Returns the new car's id, or None if the spawner is jammed.
+        """
+        cell = self.layers.index(spawner.pos)
+        if self.layers.cars[cell] > 0:
+            return None
+
+        if self.count == len(self.ids):
+            self.grow()
+
+        i = self.count
+        self.ids[i] = self.next_id
+        self.node[i] = cell
+        self.destination[i] = self.destination_rows[destination.unique_id]
+        self.in_traffic[i] = False
+        self.at_destination[i] = False
+        self.layers.cars[cell] += 1
+        spawner.spawned += 1
+
+        self.count += 1
+        self.next_id += self.id_stride
+        return int(self.ids[i])
+
+    def retire(self):
+        """
+        Drops the cars that arrived in an earlier step, packing the ones still driving at the front of the
+        arrays. Arrived cars were already taken out of the occupancy layer when they arrived.
+        """
+        driving = np.flatnonzero(~self.at_destination[:self.count])
+        if len(driving) == self.count:
+            return
+        self.model.metrics.count("cars_retired", self.count - len(driving))
+        self.keep(driving)
+
+    def keep(self, rows):
+        # Packs the given rows, in order, at the front of the arrays and drops every other car
+        for name in CAR_ARRAYS:
+            array = getattr(self, name)
+            array[:len(rows)] = array[rows]
+        self.count = len(rows)
+
+    def release(self, rows):
+        """
+        Takes the cars in rows off this engine, returning their arrays (see adopt()).
+        """
+        cars = {name: getattr(self, name)[rows].copy() for name in CAR_ARRAYS}
+        np.subtract.at(self.layers.cars, cars["node"], 1)
+        remaining = np.ones(self.count, dtype=bool)
+        remaining[rows] = False
+        self.keep(np.flatnonzero(remaining))
+        return cars
+
+    def adopt(self, cars):
+        """
+        Adds cars released by another engine on the same map, keeping their ids, routes and flags.
+        """
+        count = len(cars["ids"])
+        while self.count + count > len(self.ids):
+            self.grow()
+        for name in CAR_ARRAYS:
+            getattr(self, name)[self.count:self.count + count] = cars[name]
+        np.add.at(self.layers.cars, cars["node"], 1)
+        self.count += count
+
+    def status(self, cells, goals):
+        """
+        Vectorized check_pos_contents for an array of cells, NO_CELL where the cell is -1. goals is the
+        destination cell of the car looking at each cell, only that destination is a valid move.
+        """
+        layers = self.layers
+        valid = cells >= 0
+        safe = np.where(valid, cells, 0)
+        cell_type = layers.cell_type[safe]
+        free = layers.cars[safe] == 0
+        green = layers.light[safe]
+
+        status = np.full(cells.shape, WAIT, dtype=np.int8)
+        road = cell_type == ROAD
+        status[road] = np.where(free[road], GO, SWITCH)
+        destination = cell_type == DESTINATION
+        status[destination] = np.where(cells[destination] == np.broadcast_to(goals, cells.shape)[destination], GO, SWITCH)
+        # A green light with a car on it isn't a valid move but isn't a reason to stop looking either
+        green_light = (cell_type == TRAFFIC_LIGHT) & green
+        status[green_light] = np.where(free[green_light], GO, SWITCH)
+        status[~valid] = NO_CELL
+        return status
+
+    def step(self):
+        active = np.flatnonzero(~self.at_destination[:self.count])
+        if len(active) == 0:
+            return
+
+        pending = np.ones(len(active), dtype=bool)
+        moved = 0
+        # Random priority per car for this tick, the highest one wins a contested cell
+        priority = self.rng.random(len(active))
+
+        for pass_number in range(MAX_PASSES):
+            rows = np.flatnonzero(pending)
+            if len(rows) == 0:
+                break
+            cars = active[rows]
+            nodes = self.node[cars]
+            goals = self.destination_nodes[self.destination[cars]]
+
+            primary = self.next_hops[self.destination[cars], nodes]
+            primary_status = self.status(primary, goals)
+            self.in_traffic[cars[primary_status == WAIT]] = True
+
+            # Cars without a path stay where they are
+            stuck = primary == -1
+            target = np.where(primary_status == GO, primary, -1)
+            sidestep = np.zeros(len(cars), dtype=bool)
+
+            if pass_number > 0:
+                # Next hop not available: take the first free candidate, unless a red light comes first
+                fallback = (primary_status != GO) & ~stuck
+                candidates = self.candidates[nodes[fallback]]
+                candidate_status = self.status(candidates, goals[fallback][:, None])
+                decisive = (candidate_status == GO) | (candidate_status == WAIT)
+                first = np.argmax(decisive, axis=1)
+                first_status = np.where(decisive.any(axis=1), candidate_status[np.arange(len(first)), first], NO_CELL)
+
+                fallback_rows = np.flatnonzero(fallback)
+                moves = first_status == GO
+                target[fallback_rows[moves]] = candidates[moves, first[moves]]
+                sidestep[fallback_rows[moves]] = True
+                self.in_traffic[cars[fallback_rows[first_status == WAIT]]] = True
+
+                # Everyone that didn't get a cell this pass is done for the tick
+                pending[rows[(target == -1)]] = False
+            else:
+                pending[rows[stuck]] = False
+
+            proposing = np.flatnonzero(target != -1)
+            if len(proposing) == 0:
+                continue
+
+            # Resolve contested cells, destinations take any number of cars
+            cells = target[proposing]
+            order = np.lexsort((-priority[rows[proposing]], cells))
+            sorted_cells = cells[order]
+            first_claim = np.ones(len(order), dtype=bool)
+            first_claim[1:] = sorted_cells[1:] != sorted_cells[:-1]
+            winners = proposing[order[first_claim | (self.layers.cell_type[sorted_cells] == DESTINATION)]]
+
+            self.move(cars[winners], target[winners], sidestep[winners])
+            pending[rows[winners]] = False
+            moved += len(winners)
+
+        self.model.metrics.count("blocked_moves", len(active) - moved)
+
+    def move(self, cars, targets, sidestep):
+        cars_layer = self.layers.cars
+        np.subtract.at(cars_layer, self.node[cars], 1)
+        np.add.at(cars_layer, targets, 1)
+        self.node[cars] = targets
+        self.in_traffic[cars[sidestep]] = False
+
+        # Cars that reached their destination leave the street
+        arrived = cars[targets == self.destination_nodes[self.destination[cars]]]
+        if len(arrived) > 0:
+            self.at_destination[arrived] = True
+            np.subtract.at(cars_layer, self.node[arrived], 1)
+            for row, arrivals in enumerate(np.bincount(self.destination[arrived], minlength=len(self.destination_agents))):
+                self.destination_agents[row].arrivals += int(arrivals)
+
+    def car_state(self):
+        """
+        Ids, positions and flags of every car as parallel arrays. These are copies, frames keep them while
+        the engine moves on.
+        """
+        nodes = self.node[:self.count]
+        return {
+            "ids": self.ids[:self.count].copy(),
+            "x": nodes % self.layers.width,
+            "y": nodes // self.layers.width,
+            "in_traffic": self.in_traffic[:self.count].copy(),
+            "at_destination": self.at_destination[:self.count].copy(),
+        }
@@ -0,0 +1,202 @@
+"""
+Checkpoints of a RandomModel's full dynamic state, so a warmed-up simulation can be restored instead of
+simulated again. A checkpoint is a compressed .npz archive: a JSON header with the map, parameters,
+counters and generator states, and one array per piece of state. Routes are stored once per distinct
+route, as the cars share them, and cell positions as cell indexes (y * width + x).
+
+Restoring builds a fresh model of the same map (compiled maps come from the map cache) and overwrites its
+state, so a restored model steps exactly like the one it was taken from.
+"""
+import io
+import json
+
+import numpy as np
+
+from agent import Car_Agent
+from car_engine import CAR_ARRAYS
+
+# Media type of checkpoints on the server
+CHECKPOINT_MIMETYPE = "application/x-traffic-checkpoint"
+# Bump whenever the layout changes, older checkpoints are refused
+FORMAT_VERSION = 3
+
+
+class CheckpointUnavailable(Exception):
+    """
+    Raised by models and sessions whose state can't be saved as a checkpoint.
+    """
+
+
+def save_checkpoint(model):
+    """
+    Returns the model's state as checkpoint bytes. Metrics and the route cache aren't part of the state.
+    """
+    width = model.width
+    lights = list(model.traffic_lights.values())
+    light_rows = {light.unique_id: i for i, light in enumerate(lights)}
+    destinations = list(model.destinations.values())
+    destination_rows = {destination.unique_id: i for i, destination in enumerate(destinations)}
+
+    version, mt_state, gauss_next = model.random.getstate()
+    header = {
+        "format": FORMAT_VERSION,
+        "map_path": model.map_path,
+        "map_hash": model.map_hash,
+        "engine": "batched" if model.car_engine != None else "agents",
+        "signals": model.signals.mode,
+        "spawn_interval": model.spawn_interval,
+        "light_period": model.light_period,
+        "steps": model.schedule.steps,
+        "time": model.schedule.time,
+        "running": model.running,
+        "cars_created": model.cars_created,
+        "spawn_attempts": model.spawn_attempts,
+        "spawns_jammed": model.spawns_jammed,
+        "random_version": version,
+        "random_gauss_next": gauss_next,
+    }
+    arrays = {
+        "random_state": np.array(mt_state, dtype=np.uint32),
+        "lights": np.array([light.state for light in lights], dtype=bool),
+        "spawned": np.array([spawner.spawned for spawner in model.spawners.values()], dtype=np.int64),
+        "arrivals": np.array([destination.arrivals for destination in destinations], dtype=np.int64),
+        "signal_current": np.array([intersection.current for intersection in model.signals.intersections], dtype=np.int32),
+        "signal_elapsed": np.array([intersection.elapsed for intersection in model.signals.intersections], dtype=np.int32),
+        # Scheduled agents and the awake ones, in the order the shuffle sees them: car ids, lights as -(row + 1)
+        "schedule": schedule_keys(model.schedule.agents, light_rows),
+        "schedule_awake": schedule_keys(model.schedule.awake_agents, light_rows),
+    }
+
+    if model.car_engine != None:
+        engine = model.car_engine
+        header["engine_next_id"] = engine.next_id
+        header["engine_id_stride"] = engine.id_stride
+        header["engine_random"] = engine.rng.bit_generator.state
+        for name in CAR_ARRAYS:
+            arrays[f"car_{name}"] = getattr(engine, name)[:engine.count]
+    else:
+        cars = list(model.cars.values())
+        # Every distinct route once, cars point at theirs
+        route_rows = {}
+        routes = []
+        for car in cars:
+            if id(car.path) not in route_rows:
+                route_rows[id(car.path)] = len(routes)
+                routes.append(car.path)
+        arrays.update({
+            "car_ids": np.array([car.unique_id for car in cars], dtype=np.int64),
+            "car_node": np.array([car.pos[1] * width + car.pos[0] for car in cars], dtype=np.int32),
+            "car_destination": np.array([destination_rows[car.destination.unique_id] for car in cars], dtype=np.int32),
+            "car_cursor": np.array([car.cursor for car in cars], dtype=np.int32),
+            "car_in_traffic": np.array([car.in_traffic for car in cars], dtype=bool),
+            "car_at_destination": np.array([car.at_destination for car in cars], dtype=bool),
+            "car_route": np.array([route_rows[id(car.path)] for car in cars], dtype=np.int32),
+            "route_offsets": np.cumsum([0] + [len(route) for route in routes], dtype=np.int64),
+            "route_cells": np.array([y * width + x for route in routes for x, y in route], dtype=np.int32),
+        })
+
+    arrays["header"] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def schedule_keys(agents, light_rows):
+    return np.array([-(light_rows[agent.unique_id] + 1) if agent.unique_id in light_rows else agent.unique_id
+                     for agent in agents], dtype=np.int64)
+
+
+def read_checkpoint(data):
+    """
+    Returns the header and arrays of checkpoint bytes, raising ValueError if they aren't a checkpoint this
+    version can restore.
+    """
+    try:
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        header = json.loads(arrays.pop("header").tobytes())
+    except (OSError, ValueError, KeyError) as error:
+        raise ValueError("Not a checkpoint") from error
+    if header.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Checkpoint format {header.get('format')} isn't supported, expected {FORMAT_VERSION}")
+    return header, arrays
+
+
+def load_checkpoint(model, header, arrays):
+    """
+    Overwrites the state of a freshly built model with a checkpoint's. The model must have been built
+    from the same map and with the same engine and signal mode.
+    """
+    if header["map_hash"] != model.map_hash:
+        raise ValueError("The checkpoint was taken on a different map")
+    width = model.width
+    lights = list(model.traffic_lights.values())
+    destinations = list(model.destinations.values())
+
+    model.random.setstate((header["random_version"], tuple(arrays["random_state"].tolist()), header["random_gauss_next"]))
+    model.spawn_interval = header["spawn_interval"]
+    model.light_period = header["light_period"]
+    model.running = header["running"]
+    model.cars_created = header["cars_created"]
+    model.spawn_attempts = header["spawn_attempts"]
+    model.spawns_jammed = header["spawns_jammed"]
+
+    for light, state in zip(lights, arrays["lights"].tolist()):
+        light.state = state
+    for spawner, spawned in zip(model.spawners.values(), arrays["spawned"].tolist()):
+        spawner.spawned = spawned
+    for destination, arrivals in zip(destinations, arrays["arrivals"].tolist()):
+        destination.arrivals = arrivals
+    for intersection, current, elapsed in zip(model.signals.intersections, arrays["signal_current"].tolist(),
+                                              arrays["signal_elapsed"].tolist()):
+        intersection.current = current
+        intersection.elapsed = elapsed
+
+    cars = {}
+    if model.car_engine != None:
+        engine = model.car_engine
+        count = len(arrays["car_ids"])
+        while len(engine.ids) < count:
+            engine.grow()
+        for name in CAR_ARRAYS:
+            getattr(engine, name)[:count] = arrays[f"car_{name}"]
+        engine.count = count
+        engine.next_id = header["engine_next_id"]
+        engine.id_stride = header["engine_id_stride"]
+        engine.rng.bit_generator.state = header["engine_random"]
+        # Arrived cars already left the occupancy layer
+        np.add.at(model.layers.cars, engine.node[:count][~engine.at_destination[:count]], 1)
+    else:
+        offsets = arrays["route_offsets"].tolist()
+        cells = arrays["route_cells"].tolist()
+        routes = [tuple((cell % width, cell // width) for cell in cells[start:end])
+                  for start, end in zip(offsets, offsets[1:])]
+        for car_id, node, destination, cursor, in_traffic, at_destination, route in zip(
+                arrays["car_ids"].tolist(), arrays["car_node"].tolist(), arrays["car_destination"].tolist(),
+                arrays["car_cursor"].tolist(), arrays["car_in_traffic"].tolist(),
+                arrays["car_at_destination"].tolist(), arrays["car_route"].tolist()):
+            car = Car_Agent(car_id, model)
+            car.destination = destinations[destination]
+            car.path = routes[route]
+            car.cursor = cursor
+            car.in_traffic = in_traffic
+            car.at_destination = at_destination
+            model.grid.place_agent(car, (node % width, node // width))
+            model.index.add(car)
+            if at_destination:
+                # Arrived during the last step, retired at the start of the next one
+                model.arrived.append(car)
+            cars[car_id] = car
+
+    # Same agents, same activation order
+    def agent(key):
+        return lights[-key - 1] if key < 0 else cars[key]
+    for scheduled in list(model.schedule.agents):
+        model.schedule.remove(scheduled)
+    for key in arrays["schedule"].tolist():
+        model.schedule.add(agent(key), awake=False)
+    for key in arrays["schedule_awake"].tolist():
+        model.schedule.wake(agent(key))
+    model.schedule.steps = header["steps"]
+    model.schedule.time = header["time"]
+
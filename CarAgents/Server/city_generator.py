@@ -0,0 +1,116 @@
+"""
+Synthetic city maps in the alphabet of mapDictionary.txt, for trying the simulation on maps of any size.
+
+The city is a grid of building blocks separated by two-lane one-way streets. Inner streets alternate
+direction and the outer ones go around the city, so every destination can be reached from every spawner.
+Streets crossing each other keep the vertical street's direction, and every approach to a crossing gets a
+traffic light: horizontal ones start green ('s'), vertical ones red ('S'), so they take turns as the model
+flips them. Destinations sit on the edges of the blocks and spawners on the outer streets, starting at the
+corners.
+
+    python city_generator.py 240 240 --output ../TrafficVisualization/Assets/Data/city_240.txt
+"""
+import argparse
+import random
+
+# Lanes of every street
+LANES = 2
+# Every destination costs a distance field the size of the map, so big maps don't get one per block
+MAX_DEFAULT_DESTINATIONS = 32
+
+
+def generate_city(width, height, block=6, destinations=None, spawners=4, seed=None):
+    """
+    Returns the rows of a city map, top row first. The size is rounded down so the map starts and ends
+    with a street; maps need to fit at least two blocks each way.
+    Args:
+        width, height: Approximate size in cells
+        block: Side of a building block
+        destinations: Number of destinations, one per block up to MAX_DEFAULT_DESTINATIONS by default
+        spawners: Number of spawners, the first four at the corners and the rest along the outer streets
+        seed: Seed for placing destinations and spawners
+    """
+    rng = random.Random(seed)
+    period = block + LANES
+    blocks_x = (width - LANES) // period
+    blocks_y = (height - LANES) // period
+    if blocks_x < 2 or blocks_y < 2:
+        raise ValueError(f"A {width}x{height} map doesn't fit two {block}x{block} blocks each way")
+    width = blocks_x * period + LANES
+    height = blocks_y * period + LANES
+
+    # Street bands: rows/columns at the start of each period, band i runs the opposite way of band i-1
+    def band(i):
+        return i // period if i % period < LANES else None
+
+    grid = [["#"] * width for _ in range(height)]
+    for r in range(height):
+        for c in range(width):
+            row_band, column_band = band(r), band(c)
+            # The outer streets always go around counterclockwise, so no corner is a dead end
+            if column_band is not None:
+                grid[r][c] = "v" if column_band % 2 == 0 and column_band != blocks_x else "^"
+            elif row_band is not None:
+                grid[r][c] = "<" if row_band % 2 == 0 and row_band != blocks_y else ">"
+
+    # Lights on the cell before every crossing, on both lanes
+    for r in range(height):
+        for c in range(width):
+            row_band, column_band = band(r), band(c)
+            if row_band is not None and column_band is None:
+                # Horizontal street, is the next cell in its direction a crossing?
+                step = -1 if grid[r][c] == "<" else 1
+                if 0 <= c + step < width and band(c + step) is not None and band(c - step) is None:
+                    grid[r][c] = "s"
+            elif column_band is not None and row_band is None:
+                step = 1 if grid[r][c] == "v" else -1
+                if 0 <= r + step < height and band(r + step) is not None and band(r - step) is None:
+                    grid[r][c] = "S"
+
+    # Destinations on block cells next to a street
+    edges = [(r, c) for r in range(height) for c in range(width)
+             if grid[r][c] == "#" and any(band(r + dr) is not None and band(c + dc) is None or
+                                         band(c + dc) is not None and band(r + dr) is None
+                                         for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+                                         if 0 <= r + dr < height and 0 <= c + dc < width)]
+    if destinations is None:
+        destinations = min(blocks_x * blocks_y, MAX_DEFAULT_DESTINATIONS)
+    for r, c in rng.sample(edges, min(destinations, len(edges))):
+        grid[r][c] = "D"
+
+    # Spawners on the outer lanes, corners first
+    corners = [(0, 0), (0, width - 1), (height - 1, 0), (height - 1, width - 1)]
+    border = [(r, c) for r in range(height) for c in range(width)
+              if (r in (0, height - 1) or c in (0, width - 1)) and (r, c) not in corners and grid[r][c] in "<>^v"]
+    extra = rng.sample(border, min(max(0, spawners - len(corners)), len(border)))
+    for r, c in (corners + extra)[:spawners]:
+        grid[r][c] = "z"
+
+    return ["".join(row) for row in grid]
+
+
+def write_city(path, width, height, **options):
+    rows = generate_city(width, height, **options)
+    with open(path, "w") as output:
+        output.write("\n".join(rows) + "\n")
+    return len(rows[0]), len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic city map.")
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("--block", type=int, default=6)
+    parser.add_argument("--destinations", type=int, default=None)
+    parser.add_argument("--spawners", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="city.txt")
+    args = parser.parse_args()
+
+    width, height = write_city(args.output, args.width, args.height, block=args.block,
+                               destinations=args.destinations, spawners=args.spawners, seed=args.seed)
+    print(f"Wrote a {width}x{height} map to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Binary frame layout, little-endian, columns one after the other:
+    header  HEADER (16 bytes)
+    ids     int32[count]
+    x       int16[count]
+    z       int16[count]
+    flags   uint8[count]
+Car ids are the cars' small integer numbers, light ids are their cell index (z * width + x).
+"""
+import struct
+
+import numpy as np
+
+# Media type of the binary frames, clients ask for it with the Accept header (or ?format=binary)
+FRAME_MIMETYPE = "application/x-traffic-frame"
+
+CARS_MAGIC = b"CARS"
+LIGHTS_MAGIC = b"TLIT"
+VERSION = 1
+
+# magic, version, reserved, step, count
+HEADER = struct.Struct("<4sHHiI")
+
+# Bits of the per-car flags byte
+IN_TRAFFIC = 1
+AT_DESTINATION = 2
+# Bit of the per-light flags byte
+GREEN = 1
+
+
+def encode_columns(magic, step, ids, x, y, flags):
+    count = len(ids)
+    return b"".join([
+        HEADER.pack(magic, VERSION, 0, step, count),
+        np.asarray(ids, dtype="<i4").tobytes(),
+        np.asarray(x, dtype="<i2").tobytes(),
+        np.asarray(y, dtype="<i2").tobytes(),
+        np.asarray(flags, dtype=np.uint8).tobytes(),
+    ])
+
+
+def encode_cars(step, cars):
+    """
+    Encodes RandomModel.car_state() arrays straight into a binary frame.
+    """
+    flags = np.asarray(cars["in_traffic"], dtype=np.uint8) * IN_TRAFFIC \
+        | np.asarray(cars["at_destination"], dtype=np.uint8) * AT_DESTINATION
+    return encode_columns(CARS_MAGIC, step, cars["ids"], cars["x"], cars["y"], flags)
+
+
+def encode_lights(step, width, x, y, states):
+    ids = np.asarray(y, dtype=np.int32) * width + np.asarray(x, dtype=np.int32)
+    flags = np.asarray(states, dtype=np.uint8) * GREEN
+    return encode_columns(LIGHTS_MAGIC, step, ids, x, y, flags)
+
+
+def decode_frame(data):
+    """
+    Reads a binary frame back into arrays: {"kind", "step", "ids", "x", "y", "flags"}.
+    """
+    magic, version, _, step, count = HEADER.unpack_from(data)
+    if magic not in (CARS_MAGIC, LIGHTS_MAGIC) or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} traffic frame")
+
+    offset = HEADER.size
+    columns = {}
+    for name, dtype in [("ids", "<i4"), ("x", "<i2"), ("y", "<i2"), ("flags", np.uint8)]:
+        columns[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += count * np.dtype(dtype).itemsize
+
+    columns["kind"] = "cars" if magic == CARS_MAGIC else "lights"
+    columns["step"] = step
+    return columns
@@ -1,83 +1,346 @@
+import hashlib
+import os
+import time
+
 from agent import Car_Agent, Traffic_Light_Agent, Destination_Agent, Building_Agent, Road_Agent, Car_Spawner_Agent
-from model import RandomModel, roads, buildings, cars, traffic_lights, destinations, spawners
-from mesa.visualization.modules import CanvasGrid, BarChartModule
-from mesa.visualization.ModularVisualization import ModularServer
+from model import RandomModel
+from sharding import ShardedModel
+from checkpoint import CHECKPOINT_MIMETYPE, CheckpointUnavailable
+from trajectory import TrajectoryRecorder, Trajectory, RECORDINGS_DIR
+from sessions import SessionRegistry, ReplaySession
+from encoding import FRAME_MIMETYPE, encode_cars, encode_lights
+from streaming import FrameStream, frame_events
+from static_layers import StaticLayerCache
+from logs import get_logger, configure_logging
+from metrics import Metrics, prometheus
+from signals import MODES as SIGNAL_MODES, LEGACY
 
-import math
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, abort, make_response, g
 
 app = Flask("Traffic example")
+log = get_logger("server")
+
+# Every simulation hosted by this process, by session id
+sessions = SessionRegistry()
+# Serialized roads and buildings, shared by every session on the same map
+static_layers = StaticLayerCache()
+# Time spent in each endpoint, serialization included
+server_metrics = Metrics()
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def stop_timer(response):
+    if 'started' in g:
+        # Requests finish on several threads at once
+        with server_metrics.lock:
+            server_metrics.observe(f"endpoint_{request.endpoint}", time.perf_counter() - g.started)
+    return response
+
+def get_session():
+    # Session named by the "session" query/form parameter, or the latest one for clients that don't send it
+    session = sessions.get(request.values.get('session'))
+    if session is None:
+        abort(make_response(jsonify({"message": "Unknown or expired session, call /init first."}), 404))
+    return session
+
+def recording_path(name):
+    # Recordings are addressed by name only, never by a path of the client's choosing
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        abort(make_response(jsonify({"message": "Recording names can't be empty or contain a path."}), 400))
+    return os.path.join(RECORDINGS_DIR, name)
+
+def wants_binary():
+    # Content negotiation, binary frames for clients that accept them or ask with ?format=binary
+    if request.args.get('format') == 'binary':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', FRAME_MIMETYPE]) == FRAME_MIMETYPE
+
+def binary_response(data):
+    response = Response(data, mimetype=FRAME_MIMETYPE)
+    response.vary.add('Accept')
+    return response
+
+def static_response(layer):
+    # Clients revalidate with If-None-Match and get a 304 while the map stays the same
+    return conditional_response(Response(layer.body, mimetype='application/json'), layer.etag)
+
+def conditional_response(response, etag):
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/init', methods=['POST', 'GET'])
 def initModel():
-    global currentStep, randomModel, number_agents, number_packages, number_depots, width, height
-
     if request.method == 'POST':
 
         map_path = request.form.get('MapPath')
+        # "agents" (default) or "batched"
+        engine = request.form.get('Engine', 'agents')
+        # Steps simulated ahead in the background, 0 steps the model inside /update
+        prefetch = request.form.get('Prefetch', 32, type=int)
+        # "legacy" (default), "fixed" or "actuated" traffic light control
+        signals = request.form.get('Signals', LEGACY)
+        if signals not in SIGNAL_MODES:
+            abort(make_response(jsonify({"message": f"Unknown signal mode, expected one of {SIGNAL_MODES}."}), 400))
 
-        currentStep = 0
+        # Worker processes simulating one tile of the map each, 0 or 1 runs in the server process
+        shards = request.form.get('Shards', 0, type=int)
+        # Name to record every step under, for /replay later
+        record = request.form.get('Record')
+        path = recording_path(record) if record is not None else None
+        if path is not None and os.path.exists(path):
+            abort(make_response(jsonify({"message": f"Recording {record} already exists."}), 409))
 
-        randomModel = RandomModel(map_path)
+        if shards > 1:
+            model = ShardedModel(map_path, shards, signals=signals)
+        else:
+            model = RandomModel(map_path, engine, signals=signals)
+        recorder = TrajectoryRecorder(path, model) if path is not None else None
+        session = sessions.create(model, prefetch, recorder)
 
-        return jsonify({"message":"Parameters recieved, model initiated."})
+        return jsonify({"message":"Parameters recieved, model initiated.", "session": session.id})
 
 @app.route('/getRoads', methods=['GET'])
 def getRoads():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        roadData = [{"id": str(road.unique_id), "x": road.pos[0], "y":0, "z": road.pos[1], "direction": road.direction} for road in roads.values()]
-        return jsonify({'data': roadData})
+        def roads():
+            with session.lock:
+                roadData = [{"id": str(road.unique_id), "x": road.pos[0], "y":0, "z": road.pos[1], "direction": road.direction} for road in session.model.roads.values()]
+            return {'data': roadData}
+        return static_response(static_layers.get(session.model.map_hash, 'roads', roads))
 
 @app.route('/getCars', methods=['GET'])
 def getCars():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        carData = [{"id": str(car.unique_id), "x": car.pos[0], "y":0, "z": car.pos[1], "in_traffic": car.in_traffic, "at_destination": car.at_destination} for car in cars.values()]
-        return jsonify({'data': carData})
+        with session.lock:
+            # Served from the frame at the current step, the model itself may already be further ahead
+            frame = session.frame
+        if wants_binary():
+            return binary_response(encode_cars(frame.step, frame.cars))
+        return jsonify({'data': frame.car_data()})
 
 @app.route('/getTLights', methods=['GET'])
 def getTLights():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        tlightData = [{"id": str(tlight.unique_id), "x": tlight.pos[0], "y":0, "z": tlight.pos[1], "state": tlight.state} for tlight in traffic_lights.values()]
-        return jsonify({'data': tlightData})
+        with session.lock:
+            frame = session.frame
+        if wants_binary():
+            return binary_response(encode_lights(frame.step, session.model.width, frame.light_x, frame.light_y, frame.light_states))
+        return jsonify({'data': frame.light_data()})
 
 @app.route('/getSpawners', methods=['GET'])
 def getSpawners():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        spawnerData = [{"id": str(spawner.unique_id), "x": spawner.pos[0], "y":0, "z": spawner.pos[1], "spawned":spawner.spawned} for spawner in spawners.values()]
+        with session.lock:
+            spawned = session.frame.spawned
+            spawnerData = [{"id": str(spawner.unique_id), "x": spawner.pos[0], "y":0, "z": spawner.pos[1], "spawned":spawned[spawner.unique_id]} for spawner in session.model.spawners.values()]
         return jsonify({'data':spawnerData})
 
 @app.route('/getDestinations', methods=['GET'])
 def getDestinations():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        destinationData = [{"id": str(destination.unique_id), "x": destination.pos[0], "y":0.01, "z": destination.pos[1], "arrivals": destination.arrivals} for destination in destinations.values()]
-        print(destinationData)
-        return jsonify({'data':destinationData})
+        def destinations():
+            with session.lock:
+                return [{"id": str(destination.unique_id), "x": destination.pos[0], "y":0.01, "z": destination.pos[1]} for destination in session.model.destinations.values()]
+        layer = static_layers.get(session.model.map_hash, 'destinations', destinations)
+        with session.lock:
+            arrivals = session.frame.arrivals
+        # Positions are static, only the arrival counts change, so the ETag only changes with them
+        counts = [arrivals[destination["id"]] for destination in layer.payload]
+        etag = f"{layer.etag}-{hashlib.sha256(str(counts).encode()).hexdigest()[:16]}"
+        if request.if_none_match.contains(etag):
+            return conditional_response(Response(mimetype='application/json'), etag)
+        destinationData = [dict(destination, arrivals=count) for destination, count in zip(layer.payload, counts)]
+        log.debug("Destinations: %s", destinationData)
+        return conditional_response(jsonify({'data':destinationData}), etag)
 
 @app.route('/getBuildings', methods=['GET'])
 def getBuildings():
-    global randomModel
+    session = get_session()
 
     if request.method == 'GET':
-        buildingPositions = [{"id": str(building.unique_id), "x": building.pos[0], "y":0.01, "z": building.pos[1]} for building in buildings.values()]
-        return jsonify({'positions':buildingPositions})
+        def buildings():
+            with session.lock:
+                buildingPositions = [{"id": str(building.unique_id), "x": building.pos[0], "y":0.01, "z": building.pos[1]} for building in session.model.buildings.values()]
+            return {'positions':buildingPositions}
+        return static_response(static_layers.get(session.model.map_hash, 'buildings', buildings))
 
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, randomModel
+    session = get_session()
+
     if request.method == 'GET':
-        randomModel.step()
-        currentStep += 1
+        # ?steps=<k> fast-forwards k steps in one call
+        steps = max(1, request.args.get('steps', 1, type=int))
+        with session.lock:
+            session.advance(steps)
+            currentStep = session.current_step
         return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
 
+@app.route('/state', methods=['GET'])
+def getState():
+    # Cars and lights that changed since the client's last step (?since=<step>), or a full snapshot when that
+    # step is unknown or too old. ?advance=<k> steps the model first, so one request per frame is enough.
+    session = get_session()
+
+    if request.method == 'GET':
+        since = request.args.get('since', type=int)
+        advance = request.args.get('advance', 0, type=int)
+
+        with session.lock:
+            session.advance(advance)
+            changes = session.frame_log.since(since)
+            full = changes is None
+            if full:
+                changes = session.frame_log.snapshot()
+            currentStep = session.current_step
+            light_positions = session.frame_log.light_positions
+
+        carData = [{"id": str(car_id), "x": x, "y":0, "z": y, "in_traffic": in_traffic, "at_destination": at_destination}
+                   for car_id, (x, y, in_traffic, at_destination) in changes["cars"].items()]
+        tlightData = [{"id": str(light_id), "x": light_positions[light_id][0], "y":0, "z": light_positions[light_id][1], "state": state}
+                      for light_id, state in changes["lights"].items()]
+        return jsonify({
+            'currentStep': currentStep,
+            'since': since,
+            'full': full,
+            'cars': carData,
+            'spawned': [str(car_id) for car_id in changes["spawned"]],
+            'retired': [str(car_id) for car_id in changes["retired"]],
+            'lights': tlightData,
+        })
+
+@app.route('/stream', methods=['GET'])
+def streamFrames():
+    # Server-sent events: the server steps the session at ?rate=<steps per second> (0, the default, as fast as
+    # possible) and pushes every frame. ?buffer=<n> is how many frames may wait for a slow client before the
+    # oldest are dropped, ?format=binary sends base64 encoded binary frames instead of JSON.
+    session = get_session()
+    rate = request.args.get('rate', 0, type=float)
+    max_pending = max(1, request.args.get('buffer', 4, type=int))
+    format = 'binary' if request.args.get('format') == 'binary' else 'json'
+
+    with session.lock:
+        if session.stream is None:
+            session.stream = FrameStream(session, rate)
+        elif 'rate' in request.args:
+            session.stream.rate = rate
+        stream = session.stream
+    subscriber = stream.subscribe(max_pending)
+    width = session.model.width
+
+    def events():
+        try:
+            while not subscriber.closed:
+                frame = subscriber.next()
+                if frame is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield frame_events(frame, width, format)
+        finally:
+            stream.unsubscribe(subscriber)
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    # Prometheus text format: the model metrics of every session added up, plus the endpoint timings
+    total = sessions.metrics()
+    total.merge(server_metrics)
+    gauges = {"sessions": len(sessions), "static_layers_cached": len(static_layers)}
+    return Response(prometheus(total, gauges=gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/checkpoint', methods=['GET'])
+def getCheckpoint():
+    # Full model state as a binary checkpoint, POST it to /restore to start a session from it.
+    # Sessions with Prefetch simulate ahead of the client, their checkpoint is of the latest simulated step
+    # rather than currentStep: X-Checkpoint-Step says which step it holds.
+    session = get_session()
+
+    if request.method == 'GET':
+        with session.lock:
+            try:
+                data, step = session.checkpoint()
+            except CheckpointUnavailable as error:
+                abort(make_response(jsonify({"message": str(error)}), 400))
+        response = Response(data, mimetype=CHECKPOINT_MIMETYPE)
+        response.headers['Content-Disposition'] = f'attachment; filename="{session.id}.ckpt"'
+        response.headers['X-Checkpoint-Step'] = str(step)
+        return response
+
+@app.route('/restore', methods=['POST'])
+def restoreModel():
+    # New session from a checkpoint sent as the request body, ?prefetch=<k> as in /init
+    if request.method == 'POST':
+        prefetch = request.args.get('prefetch', 32, type=int)
+        try:
+            model = RandomModel.from_checkpoint(request.get_data())
+        except ValueError as error:
+            abort(make_response(jsonify({"message": str(error)}), 400))
+
+        session = sessions.create(model, prefetch)
+        log.info("Session %s restored at step %s", session.id, session.current_step)
+
+        return jsonify({"message":"Checkpoint restored, model initiated.", "session": session.id, "currentStep": session.current_step})
+
+@app.route('/replay', methods=['POST'])
+def replayRecording():
+    # New session playing back a recording made with /init's Record, no simulation involved
+    if request.method == 'POST':
+        name = request.form.get('Recording')
+        path = recording_path(name)
+        if not os.path.isdir(path):
+            abort(make_response(jsonify({"message": f"No recording named {name}."}), 404))
+        trajectory = Trajectory(path)
+        if len(trajectory) == 0:
+            abort(make_response(jsonify({"message": f"Recording {name} has no steps yet."}), 400))
+
+        # Only for the roads, buildings and other static layers, never stepped
+        model = RandomModel(trajectory.meta["map_path"])
+        if model.map_hash != trajectory.meta["map_hash"]:
+            abort(make_response(jsonify({"message": f"The map of recording {name} has changed since it was recorded."}), 409))
+        session = sessions.replay(model, trajectory)
+
+        return jsonify({"message":"Recording loaded.", "session": session.id,
+                        "firstStep": trajectory.first_step(), "lastStep": trajectory.last_step()})
+
+@app.route('/seek', methods=['GET'])
+def seekReplay():
+    # Jumps a replay to ?step=<n>, or the closest recorded step before it
+    session = get_session()
+
+    if request.method == 'GET':
+        if not isinstance(session, ReplaySession):
+            abort(make_response(jsonify({"message": "Only replays can seek, live sessions use /update."}), 400))
+        step = request.args.get('step', 0, type=int)
+        with session.lock:
+            session.seek(step)
+            currentStep = session.current_step
+        return jsonify({'message':f'Replay moved to step {currentStep}.', 'currentStep':currentStep})
+
+@app.route('/close', methods=['POST', 'GET'])
+def closeModel():
+    # Free a session right away instead of waiting for it to expire
+    session = get_session()
+    sessions.remove(session.id)
+    return jsonify({'message':f'Session {session.id} closed.'})
+
 if __name__=='__main__':
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    configure_logging()
+    app.run(host="localhost", port=8585, debug=True)
@@ -0,0 +1,136 @@
+from collections import deque
+
+import numpy as np
+
+
+class Frame:
+    """
+    State of the simulation after one step, as the getters serve it: car arrays (see RandomModel.car_state),
+    traffic light ids, positions and states, and the spawned/arrivals counters by agent id.
+    """
+    def __init__(self, step, cars, light_ids, light_x, light_y, light_states, spawned, arrivals):
+        self.step = step
+        self.cars = cars
+        self.light_ids = light_ids
+        self.light_x = light_x
+        self.light_y = light_y
+        self.light_states = light_states
+        self.spawned = spawned
+        self.arrivals = arrivals
+
+    def car_records(self):
+        """
+        {id: (x, y, in_traffic, at_destination)} of the cars still driving.
+        """
+        cars = self.cars
+        ids = cars["ids"].tolist() if isinstance(cars["ids"], np.ndarray) else cars["ids"]
+        return {car_id: (x, y, in_traffic, False)
+                for car_id, x, y, in_traffic, at_destination
+                in zip(ids, cars["x"].tolist(), cars["y"].tolist(), cars["in_traffic"].tolist(), cars["at_destination"].tolist())
+                if not at_destination}
+
+    def light_records(self):
+        return dict(zip(self.light_ids, self.light_states.tolist()))
+
+    def car_data(self):
+        """
+        Cars in the JSON layout of /getCars.
+        """
+        cars = self.cars
+        ids = cars["ids"].tolist() if isinstance(cars["ids"], np.ndarray) else cars["ids"]
+        return [{"id": str(car_id), "x": x, "y":0, "z": y, "in_traffic": in_traffic, "at_destination": at_destination}
+                for car_id, x, y, in_traffic, at_destination
+                in zip(ids, cars["x"].tolist(), cars["y"].tolist(), cars["in_traffic"].tolist(), cars["at_destination"].tolist())]
+
+    def light_data(self):
+        """
+        Traffic lights in the JSON layout of /getTLights.
+        """
+        return [{"id": str(light_id), "x": x, "y":0, "z": y, "state": state}
+                for light_id, x, y, state in zip(self.light_ids, self.light_x.tolist(), self.light_y.tolist(), self.light_states.tolist())]
+
+
+def light_state(model):
+    """
+    Ids, x, y and states of every traffic light as parallel arrays.
+    """
+    lights = list(model.traffic_lights.values())
+    return (
+        [light.unique_id for light in lights],
+        np.array([light.pos[0] for light in lights], dtype=np.int32),
+        np.array([light.pos[1] for light in lights], dtype=np.int32),
+        np.array([light.state for light in lights], dtype=bool),
+    )
+
+
+def capture_frame(model, step):
+    spawned = {spawner.unique_id: spawner.spawned for spawner in model.spawners.values()}
+    arrivals = {destination.unique_id: destination.arrivals for destination in model.destinations.values()}
+    return Frame(step, model.car_state(), *light_state(model), spawned, arrivals)
+
+
+class FrameLog:
+    """
+    Changes of the last `history` steps, so a client can ask for everything that changed since the last step
+    it saw instead of downloading every car and light again.
+    Each entry has the cars that spawned, moved or changed flags, the ids that were spawned or retired
+    (arrived), and the lights that flipped.
+    """
+    def __init__(self, history=256):
+        self.deltas = deque(maxlen=history)
+        self.step = None
+        self.cars = {}
+        self.lights = {}
+        self.light_positions = {}
+
+    def record(self, frame):
+        cars = frame.car_records()
+        lights = frame.light_records()
+
+        if self.step is not None:
+            self.deltas.append({
+                "step": frame.step,
+                "cars": {car_id: car for car_id, car in cars.items() if self.cars.get(car_id) != car},
+                "spawned": [car_id for car_id in cars if car_id not in self.cars],
+                "retired": [car_id for car_id in self.cars if car_id not in cars],
+                "lights": {light_id: state for light_id, state in lights.items() if self.lights.get(light_id) != state},
+            })
+        else:
+            self.light_positions = dict(zip(frame.light_ids, zip(frame.light_x.tolist(), frame.light_y.tolist())))
+
+        self.step = frame.step
+        self.cars = cars
+        self.lights = lights
+
+    def since(self, step):
+        """
+        Merged changes after `step` up to the latest recorded step, or None if that range is no longer (or
+        not yet) covered and the client needs a full snapshot.
+        """
+        if self.step is None or step is None or step > self.step:
+            return None
+        if step < self.step and (len(self.deltas) == 0 or self.deltas[0]["step"] > step + 1):
+            return None
+
+        cars = {}
+        spawned = set()
+        retired = set()
+        lights = {}
+        for delta in self.deltas:
+            if delta["step"] <= step:
+                continue
+            cars.update(delta["cars"])
+            spawned.update(delta["spawned"])
+            lights.update(delta["lights"])
+            for car_id in delta["retired"]:
+                cars.pop(car_id, None)
+                if car_id in spawned:
+                    # Spawned and retired since the client's step, it never needs to know about it
+                    spawned.discard(car_id)
+                else:
+                    retired.add(car_id)
+
+        return {"cars": cars, "spawned": list(spawned), "retired": list(retired), "lights": lights}
+
+    def snapshot(self):
+        return {"cars": self.cars, "spawned": [], "retired": [], "lights": self.lights}
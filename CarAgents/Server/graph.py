@@ -8,35 +8,51 @@
 from typing import Tuple, TypeVar
 import heapq
 
+from map_compiler import TRAFFIC_LIGHT
+
 T = TypeVar('T')
 Location = TypeVar('Location')
 GridLocation = Tuple[int, int]
 
-class WeightedGraph:
-    def __init__(self, dict):
-        self.weighted_graph = {}
-
-        # Build dictionary
-        print(dict)
-        for key in dict:
-            self.add_node((key, dict[key]), 1)
+# Extra cost of moving into a cell that already holds a car
+OCCUPIED_COST = 3
+# Extra cost of moving into a traffic light that is currently red
+RED_LIGHT_COST = 5
+# Maximum number of nodes a single route repair is allowed to expand before giving up
+MAX_REPAIR_EXPANSIONS = 200
 
 
-    def add_node(self, node, weight):
-        self.weighted_graph[node[0]] = [node[1], weight]
-        # print(self.weighted_graph[node[0]])
-    
+class WeightedGraph:
+    """
+    Live-weighted view of the model's RoadGraph. Edge costs are read from the model's cell layers on every
+    call, so they always reflect the current occupancy and traffic light states.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.road_graph = model.road_graph
+
+
+    def neighbors(self, node):
+        return self.road_graph.neighbors(node)
+
+
+    def cost(self, current, next):
+        # Base cost of one cell, plus a penalty if the next cell is taken or is a red light
+        cost = 1
+        layers = self.model.layers
+        if layers.cars[next] > 0:
+            cost += OCCUPIED_COST
+        if layers.cell_type[next] == TRAFFIC_LIGHT and not layers.light[next]:
+            cost += RED_LIGHT_COST
+        return cost
 
-    def neighbors(self, pos):
-        neighbor_list = self.weighted_graph[f"({pos[0]}, {pos[1]})"][0]
-        # print(f"> NEIGHBOR LIST: {neighbor_list}")
-        return neighbor_list
-    
 
-    def cost(self, pos):
-        cost = self.weighted_graph[f"({pos[0]}, {pos[1]})"][1]
-        # print(f"> COST: {cost}")
-        return cost
+    def heuristic(self, node, goal):
+        # The static distance field is exact for unit costs, so it never overestimates the live cost
+        field = self.model.distance_fields.get(self.road_graph.position(goal))
+        if field is not None and field[0][node] != -1:
+            return int(field[0][node])
+        return heuristic(self.road_graph.position(node), self.road_graph.position(goal))
 
 
 class PriorityQueue:
@@ -46,11 +62,11 @@ class PriorityQueue:
     # Return whether the queue is empty
     def empty(self) -> bool:
         return not self.elements
-    
+
     # Add an item to the queue depending on its priority
     def put(self, item: T, priority: float):
         heapq.heappush(self.elements, (priority, item))
-    
+
     # Remove and return the item with the highest priority
     def get(self) -> T:
         return heapq.heappop(self.elements)[1]
@@ -63,7 +79,6 @@ def heuristic(a: GridLocation, b: GridLocation) -> float:
 
 
 def a_star_search(graph: WeightedGraph, start: Location, goal: Location):
-    print(f"> A_STAR GOAL: {goal}")
     # Initialize priority queue with start node
     frontier = PriorityQueue()
     # Add start position without cost
@@ -75,25 +90,70 @@ def a_star_search(graph: WeightedGraph, start: Location, goal: Location):
     # Define start location as None and cost as 0 for initial cost
     came_from[start] = None
     cost_so_far[start] = 0
-    
+
     # While the queue contains elements
     while not frontier.empty():
         # Obtain queue item to evaluate
         current: Location = frontier.get()
-        
+
         if current == goal:
-            print(">>> BROKE OFF SEARCH !!! ")
             break
-        
+
         for next in graph.neighbors(current):
-            print(f"> Next of {current}: {next}")
-            new_cost = cost_so_far[current] + graph.cost(current)
+            new_cost = cost_so_far[current] + graph.cost(current, next)
             if next not in cost_so_far or new_cost < cost_so_far[next]:
                 # Recalculate cost, priority, and add to priority queue
                 cost_so_far[next] = new_cost
-                priority = new_cost + heuristic(next, goal)
+                priority = new_cost + graph.heuristic(next, goal)
                 frontier.put(next, priority)
                 # Update origin
                 came_from[next] = current
-                
-    return came_from, cost_so_far
\ No newline at end of file
+
+    return came_from, cost_so_far
+
+
+def repair_path(graph: WeightedGraph, start: Location, old_path: list, max_expansions: int = MAX_REPAIR_EXPANSIONS):
+    """
+    Repairs a plan after the car left it. Instead of searching all the way to the goal, A* only searches
+    until it rejoins the old path, and the untouched tail of the old path is reused as is.
+    Nodes are RoadGraph indices, old_path ends at the goal. Returns the new node path from start,
+    or None if the old path can't be rejoined within max_expansions.
+    """
+    goal = old_path[-1]
+    # Cells left to travel from each node of the old path to the goal along that path
+    remaining = {node: len(old_path) - 1 - i for i, node in enumerate(old_path)}
+
+    frontier = PriorityQueue()
+    frontier.put((start, False), 0)
+    came_from = {start: None}
+    cost_so_far = {start: 0}
+    expansions = 0
+
+    while not frontier.empty():
+        current, rejoined = frontier.get()
+
+        # A rejoin entry is popped only once its total cost (detour + old tail) is the cheapest option
+        if rejoined:
+            detour = []
+            while current is not None:
+                detour.append(current)
+                current = came_from[current]
+            detour.reverse()
+            return detour + old_path[old_path.index(detour[-1]) + 1:]
+
+        if current in remaining:
+            frontier.put((current, True), cost_so_far[current] + remaining[current])
+            continue
+
+        expansions += 1
+        if expansions > max_expansions:
+            return None
+
+        for next in graph.neighbors(current):
+            new_cost = cost_so_far[current] + graph.cost(current, next)
+            if next not in cost_so_far or new_cost < cost_so_far[next]:
+                cost_so_far[next] = new_cost
+                frontier.put((next, False), new_cost + graph.heuristic(next, goal))
+                came_from[next] = current
+
+    return None
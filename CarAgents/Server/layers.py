@@ -0,0 +1,50 @@
+import numpy as np
+from mesa.space import MultiGrid
+
+from agent import Car_Agent, Traffic_Light_Agent
+
+
+class CellLayers:
+    """
+    Dense per-cell arrays indexed by RoadGraph node (y * width + x), so cars can check a cell with a few
+    array reads instead of going through the grid's agent lists.
+    Args:
+        cell_types, directions: Static (height, width) layers of the compiled map
+    """
+    def __init__(self, cell_types, directions):
+        self.height, self.width = cell_types.shape
+        self.cell_type = np.asarray(cell_types).reshape(-1)
+        self.direction = np.asarray(directions).reshape(-1)
+        # True while the traffic light on the cell is green
+        self.light = np.zeros(self.width * self.height, dtype=bool)
+        # Number of cars on each cell
+        self.cars = np.zeros(self.width * self.height, dtype=np.int32)
+
+    def index(self, pos):
+        return pos[1] * self.width + pos[0]
+
+
+class LayeredGrid(MultiGrid):
+    """
+    MultiGrid that keeps the car occupancy and light state layers in sync as agents are placed, moved and
+    removed. move_agent goes through remove_agent and place_agent, so it is covered too.
+    """
+    def __init__(self, width, height, torus, layers):
+        super().__init__(width, height, torus)
+        self.layers = layers
+
+    def place_agent(self, agent, pos):
+        x, y = pos
+        if isinstance(agent, Car_Agent):
+            # MultiGrid ignores placing an agent on the cell it already is in
+            if agent.pos is None or agent not in self._grid[x][y]:
+                self.layers.cars[y * self.width + x] += 1
+        super().place_agent(agent, pos)
+        if isinstance(agent, Traffic_Light_Agent):
+            self.layers.light[y * self.width + x] = agent.state
+
+    def remove_agent(self, agent):
+        if isinstance(agent, Car_Agent):
+            x, y = agent.pos
+            self.layers.cars[y * self.width + x] -= 1
+        super().remove_agent(agent)
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from map_compiler import read_map, cell_layers, compile_road_graph, compile_distance_fields
+from road_graph import RoadGraph
+
+# Directory compiled maps are written to, one subdirectory per map hash
+CACHE_DIR = "map_cache"
+# Bump whenever the compiled layout or the compilation rules change, so old artifacts are ignored
+FORMAT_VERSION = "1"
+
+ARRAYS = ["chars", "cell_types", "directions", "indptr", "indices", "road_mask",
+          "destinations", "distances", "next_hops"]
+
+
+class CompiledMap:
+    """
+    Everything RandomModel derives from a map file before placing agents: the character map, cell type and
+    direction layers, the RoadGraph and the per-destination distance fields.
+    """
+    def __init__(self, key, arrays):
+        self.key = key
+        self.chars = arrays["chars"]
+        self.cell_types = arrays["cell_types"]
+        self.directions = arrays["directions"]
+        self.height, self.width = self.chars.shape
+        self.road_graph = RoadGraph(self.width, self.height, arrays["indptr"], arrays["indices"], arrays["road_mask"])
+
+        # Row i of distances / next_hops is the table of the i-th destination
+        self.destinations = [tuple(int(v) for v in position) for position in arrays["destinations"]]
+        self.distances = arrays["distances"]
+        self.next_hops = arrays["next_hops"]
+        self.distance_fields = {position: (self.distances[i], self.next_hops[i])
+                                for i, position in enumerate(self.destinations)}
+
+
+def map_hash(map_path, dictionary_path):
+    """
+    Content hash of the map and dictionary files, so editing either one compiles the map again.
+    """
+    digest = hashlib.sha256(FORMAT_VERSION.encode())
+    for path in [map_path, dictionary_path]:
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:32]
+
+
+def compile_map(map_path, dataDictionary):
+    chars = read_map(map_path)
+    cell_types, directions = cell_layers(chars, dataDictionary)
+    road_graph = compile_road_graph(cell_types, directions)
+    positions, distances, next_hops = compile_distance_fields(road_graph, cell_types)
+
+    return {
+        "chars": chars,
+        "cell_types": cell_types,
+        "directions": directions,
+        "indptr": road_graph.indptr,
+        "indices": road_graph.indices,
+        "road_mask": road_graph.road_mask,
+        "destinations": np.array(positions, dtype=np.int32).reshape(-1, 2),
+        "distances": distances,
+        "next_hops": next_hops,
+    }
+
+
+def load_compiled_map(map_path, dataDictionary, dictionary_path="mapDictionary.txt", cache_dir=CACHE_DIR):
+    """
+    Returns the CompiledMap of map_path. Compiled arrays are stored as .npy files keyed by the content hash
+    of the map and dictionary, and memory-mapped on later loads instead of being compiled again.
+    """
+    key = map_hash(map_path, dictionary_path)
+    path = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(path):
+        arrays = compile_map(map_path, dataDictionary)
+        store_compiled_map(path, arrays)
+        return CompiledMap(key, arrays)
+
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+    return CompiledMap(key, arrays)
+
+
+def store_compiled_map(path, arrays):
+    staging = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write into a temporary directory first, so a concurrent load never sees half an artifact
+        staging = tempfile.mkdtemp(dir=os.path.dirname(path))
+        for name in ARRAYS:
+            np.save(os.path.join(staging, f"{name}.npy"), arrays[name])
+    except OSError:
+        # Read-only or full disk, the map still works, it just isn't cached
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        return
+
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Someone else stored the same map first
+        shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,184 @@
+import numpy as np
+
+from road_graph import RoadGraph
+from bfs3 import bfs_distance_field
+
+# Cell types of the compiled map
+EMPTY = 0
+ROAD = 1
+TRAFFIC_LIGHT = 2
+BUILDING = 3
+DESTINATION = 4
+SPAWNER = 5
+
+# Directions of the compiled map, NONE for cells without one
+NONE = 0
+UP = 1
+RIGHT = 2
+DOWN = 3
+LEFT = 4
+
+DIRECTION_NAMES = {"Up": UP, "Right": RIGHT, "Down": DOWN, "Left": LEFT}
+
+# (dx, dy) offsets of the 8 neighbors
+N_UP = (0, 1)
+N_UR = (1, 1)
+N_RIGHT = (1, 0)
+N_DR = (1, -1)
+N_DOWN = (0, -1)
+N_DL = (-1, -1)
+N_LEFT = (-1, 0)
+N_UL = (-1, 1)
+
+# Cells a car may consider from a cell facing each direction, in the order cars try them
+CANDIDATES = {
+    UP: [N_LEFT, N_UL, N_UP, N_UR, N_RIGHT],
+    RIGHT: [N_UP, N_UR, N_RIGHT, N_DR, N_DOWN],
+    DOWN: [N_RIGHT, N_DR, N_DOWN, N_DL, N_LEFT],
+    LEFT: [N_DOWN, N_DL, N_LEFT, N_UL, N_UP],
+}
+SPAWNER_CANDIDATES = [N_UP, N_RIGHT, N_DOWN, N_LEFT]
+MAX_CANDIDATES = 5
+
+# Road directions that can be entered from each neighbor, i.e. the road doesn't point back at the car
+ALLOWED_ROAD_DIRECTIONS = {
+    N_UP: [LEFT, UP, RIGHT],
+    N_RIGHT: [UP, RIGHT, DOWN],
+    N_DOWN: [RIGHT, DOWN, LEFT],
+    N_LEFT: [DOWN, LEFT, UP],
+    N_UR: [UP, RIGHT],
+    N_DR: [RIGHT, DOWN],
+    N_DL: [DOWN, LEFT],
+    N_UL: [LEFT, UP],
+}
+
+
+def read_map(map_path):
+    """
+    Reads an ASCII map into a (height, width) character array indexed [y, x], with y = 0 at the bottom row
+    like the MultiGrid.
+    """
+    with open(map_path) as baseFile:
+        lines = baseFile.readlines()
+    width = len(lines[0]) - 1
+    rows = [list(line.rstrip("\n").ljust(width)[:width]) for line in lines]
+    return np.array(rows[::-1], dtype="<U1")
+
+
+def cell_layers(chars, dataDictionary):
+    """
+    Translates a character map into cell type and direction arrays.
+    """
+    cell_types = np.full(chars.shape, EMPTY, dtype=np.uint8)
+    directions = np.full(chars.shape, NONE, dtype=np.uint8)
+
+    for symbol, value in dataDictionary.items():
+        mask = chars == symbol
+        if value in DIRECTION_NAMES:
+            cell_types[mask] = ROAD
+            directions[mask] = DIRECTION_NAMES[value]
+
+    cell_types[(chars == "S") | (chars == "s")] = TRAFFIC_LIGHT
+    cell_types[chars == "#"] = BUILDING
+    cell_types[chars == "D"] = DESTINATION
+    cell_types[chars == "z"] = SPAWNER
+    return cell_types, directions
+
+
+def shift(layer, offset, fill):
+    """
+    Returns the value of each cell's neighbor at (x + dx, y + dy), fill where the neighbor is off the grid.
+    """
+    dx, dy = offset
+    height, width = layer.shape
+    shifted = np.full(layer.shape, fill, dtype=layer.dtype)
+    shifted[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)] = \
+        layer[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)]
+    return shifted
+
+
+def facing(cell_types, directions):
+    """
+    Direction each cell of the street graph is driven in. Roads use their own direction, traffic lights
+    take the direction of the road leading into them.
+    """
+    facing = np.where(cell_types == ROAD, directions, NONE).astype(np.uint8)
+    is_light = cell_types == TRAFFIC_LIGHT
+
+    # Checked in this order, a later match wins
+    for offset, incoming in [(N_DOWN, UP), (N_LEFT, RIGHT), (N_UP, DOWN), (N_RIGHT, LEFT)]:
+        neighbor_is_road = shift(cell_types, offset, EMPTY) == ROAD
+        neighbor_direction = shift(directions, offset, NONE)
+        facing[is_light & neighbor_is_road & (neighbor_direction == incoming)] = incoming
+
+    return facing
+
+
+def compile_road_graph(cell_types, directions):
+    """
+    Builds the street graph for every cell at once using array shifts.
+    Roads and traffic lights may move to the cells around their facing direction (never backwards), spawners
+    to any adjacent road. Only roads may enter traffic lights and destinations, and a road can't enter them
+    sideways. Destinations are sinks.
+    """
+    height, width = cell_types.shape
+    size = width * height
+    cell_facing = facing(cell_types, directions)
+    node_ids = np.arange(size, dtype=np.int32).reshape(height, width)
+
+    # Candidate target node per cell and slot, -1 where the move isn't allowed
+    targets = np.full((height, width, MAX_CANDIDATES), -1, dtype=np.int32)
+
+    def fill_slot(source_mask, slot, offset, allowed):
+        target = shift(node_ids, offset, -1)
+        valid = source_mask & allowed & (target != -1)
+        targets[..., slot][valid] = target[valid]
+
+    is_road = cell_types == ROAD
+    is_light = cell_types == TRAFFIC_LIGHT
+
+    for direction, offsets in CANDIDATES.items():
+        source_mask = (is_road | is_light) & (cell_facing == direction)
+        for slot, offset in enumerate(offsets):
+            neighbor_type = shift(cell_types, offset, EMPTY)
+            neighbor_direction = shift(directions, offset, NONE)
+
+            allowed = (neighbor_type == ROAD) & np.isin(neighbor_direction, ALLOWED_ROAD_DIRECTIONS[offset])
+
+            # Roads may also enter lights and destinations, except sideways
+            sideways = offset[1] == 0 if direction in (UP, DOWN) else offset[0] == 0
+            if not sideways:
+                enters_stop = (neighbor_type == TRAFFIC_LIGHT) | (neighbor_type == DESTINATION)
+                allowed = allowed | (enters_stop & is_road)
+
+            fill_slot(source_mask, slot, offset, allowed)
+
+    is_spawner = cell_types == SPAWNER
+    for slot, offset in enumerate(SPAWNER_CANDIDATES):
+        fill_slot(is_spawner, slot, offset, shift(cell_types, offset, EMPTY) == ROAD)
+
+    # Flatten to CSR, row-major order keeps nodes by index and candidates in the order cars try them
+    targets = targets.reshape(size, MAX_CANDIDATES)
+    valid = targets != -1
+    indptr = np.zeros(size + 1, dtype=np.int32)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+
+    road_mask = np.isin(cell_types, [ROAD, TRAFFIC_LIGHT, SPAWNER, DESTINATION]).reshape(size)
+    return RoadGraph(width, height, indptr, targets[valid], road_mask)
+
+
+def compile_distance_fields(road_graph, cell_types):
+    """
+    Runs one reverse BFS per destination. Returns the destination positions plus (destinations, nodes)
+    distance and next-hop arrays, -1 where a node can't reach the destination.
+    """
+    reverse_graph = road_graph.reverse()
+    positions = [(int(x), int(y)) for y, x in np.argwhere(cell_types == DESTINATION)]
+
+    size = road_graph.width * road_graph.height
+    distances = np.empty((len(positions), size), dtype=np.int32)
+    next_hops = np.empty((len(positions), size), dtype=np.int32)
+    for i, position in enumerate(positions):
+        distances[i], next_hops[i] = bfs_distance_field(reverse_graph, position)
+
+    return positions, distances, next_hops
@@ -1,5 +1,6 @@
 from agent import Car_Agent, Traffic_Light_Agent, Destination_Agent, Building_Agent, Road_Agent, Car_Spawner_Agent
-from model import RandomModel, roads, buildings, cars, traffic_lights, destinations, spawners
+from model import RandomModel
+from logs import configure_logging
 from mesa.visualization.modules import CanvasGrid, BarChartModule
 from mesa.visualization.ModularVisualization import ModularServer
 
@@ -60,5 +61,6 @@ grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
 
 server = ModularServer(RandomModel, [grid], "Traffic Base", model_params)
 
+configure_logging()
 server.port = 8521 # The default
 server.launch()
\ No newline at end of file
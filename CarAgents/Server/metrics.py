@@ -0,0 +1,115 @@
+"""
+Counters and phase timers. A model keeps its own Metrics, so a batch run can report where its time went,
+and the Flask server exposes the totals of every session in the Prometheus text format on /metrics.
+"""
+import threading
+import time
+
+
+class Timer:
+    """
+    Context manager adding the time spent inside it to one phase of a Metrics.
+    """
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """
+    Event counters and per-phase timers (number of calls, total and slowest time).
+    count() and observe() don't lock, they run for every car and phase of every step: a Metrics must only
+    be updated from one thread at a time (a model's from the thread stepping it). snapshot() and the merges
+    lock, so other threads can read the totals while it is updated.
+    """
+    def __init__(self):
+        self.counters = {}
+        # name: [calls, total seconds, max seconds]
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def time(self, name):
+        return Timer(self, name)
+
+    def merge(self, other):
+        """
+        Adds the counts and times of another Metrics to these.
+        """
+        self.merge_snapshot(*other.snapshot())
+
+    def merge_snapshot(self, counters, timers):
+        """
+        Same as merge(), for a snapshot() taken elsewhere, e.g. in another process.
+        """
+        with self.lock:
+            for name, amount in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, (calls, total, slowest) in timers.items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], slowest)
+
+    def snapshot(self):
+        with self.lock:
+            # Copied in one go first, the writer may add a name meanwhile
+            return dict(self.counters), {name: tuple(timer) for name, timer in list(self.timers.items())}
+
+    def summary(self):
+        """
+        Flat dict for one run: every counter, and calls, total and mean seconds of every phase.
+        """
+        counters, timers = self.snapshot()
+        summary = dict(counters)
+        for name, (calls, total, slowest) in timers.items():
+            summary[f"{name}_calls"] = calls
+            summary[f"{name}_seconds"] = total
+            summary[f"{name}_mean_seconds"] = total / calls if calls else 0.0
+        return summary
+
+
+def prometheus(metrics, prefix="traffic", gauges=None):
+    """
+    Metrics in the Prometheus text exposition format. Counters become <prefix>_events_total{event=...},
+    timers <prefix>_phase_seconds summaries labelled by phase, and gauges (name: value) are written as is.
+    """
+    counters, timers = metrics.snapshot()
+    lines = [f"# TYPE {prefix}_events_total counter"]
+    for name, amount in sorted(counters.items()):
+        lines.append(f'{prefix}_events_total{{event="{name}"}} {amount}')
+
+    lines.append(f"# TYPE {prefix}_phase_seconds summary")
+    for name, (calls, total, slowest) in sorted(timers.items()):
+        lines.append(f'{prefix}_phase_seconds_count{{phase="{name}"}} {calls}')
+        lines.append(f'{prefix}_phase_seconds_sum{{phase="{name}"}} {total:.9f}')
+    lines.append(f"# TYPE {prefix}_phase_seconds_max gauge")
+    for name, (calls, total, slowest) in sorted(timers.items()):
+        lines.append(f'{prefix}_phase_seconds_max{{phase="{name}"}} {slowest:.9f}')
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,255 +1,276 @@
 from mesa import Model
-from mesa.time import RandomActivation
-from mesa.space import MultiGrid
 from agent import *
 import json
-# from graph import WeightedGraph
+import logging
+from map_cache import load_compiled_map
+from layers import CellLayers, LayeredGrid
+from agent_index import AgentIndex
+from car_engine import BatchedCarEngine
+import numpy as np
+from graph import WeightedGraph
+from route_cache import RouteCache
+from logs import get_logger
+from metrics import Metrics
+from scheduler import ActiveSetActivation
+from signals import SignalController, LEGACY
+from checkpoint import save_checkpoint, read_checkpoint, load_checkpoint
 
-cars = {}
-roads = {}
-cars = {}
-traffic_lights = {}
-destinations = {}
-spawners = {}
-buildings = {}
+log = get_logger("model")
 
 class RandomModel(Model):
     """
     Creates a new model with random agents.
     Args:
-        N: Number of agents in the simulation
-        height, width: The size of the grid to model
+        map_path: Map file, relative to the TrafficVisualization project
+        engine: "agents" to step every car as a Car_Agent, "batched" to move all cars at once with a
+            BatchedCarEngine (no Car_Agent objects are created)
+        seed: Seed of the model's random number generator, None for a random run
+        spawn_interval: Every how many steps the spawners add a car
+        light_period: Every how many steps the traffic lights flip, in "legacy" signal mode
+        signals: Traffic light controller, "legacy" to flip every light at once, "fixed" for fixed-time
+            plans per intersection or "actuated" to extend green by queue length (see signals.py)
     """
-    def __init__(self, map_path):
+    def __init__(self, map_path, engine="agents", seed=None, spawn_interval=2, light_period=10, signals=LEGACY):
 
         dataDictionary = json.load(open("mapDictionary.txt"))
+        self.map_path = map_path
 
-        self.coord_graph = {}
-
-        with open(f"../TrafficVisualization/{map_path}") as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0]) - 1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height,torus = False) 
-            self.schedule = RandomActivation(self)
-
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<"]:
-                        agent = Road_Agent(f"r_{r*self.width+c}", self, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                    elif col in ["S", "s"]:
-                        agent = Traffic_Light_Agent(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(dataDictionary[col]))
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        # Additionally, add a road agent with same direction as road before traffic light
-
-                    elif col == "#":
-                        agent = Building_Agent(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                    elif col == "D":
-                        agent = Destination_Agent(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        # self.destinations.append((c, self.height - r - 1))
-                    elif col == "z":
-                        agent = Car_Spawner_Agent(f"cs_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-        # Generate weighted graph for A* pathfinding
-        # self.graph = WeightedGraph(self.generate_graph())
-        # self.print_graph()
-        self.generate_graph()
-
-        # Loop through all agents and add them to their respective dictionary
+        # Mesa only picks the seed up when it's passed by keyword
+        if seed != None:
+            self.reset_randomizer(seed)
+        self.spawn_interval = spawn_interval
+        self.light_period = light_period
+        # Spawn attempts and how many of them found the spawner's cell taken
+        self.spawn_attempts = 0
+        self.spawns_jammed = 0
+
+        # Number of cars created so far, source of the cars' small integer ids
+        self.cars_created = 0
+
+        # Phase timers and event counters of this model
+        self.metrics = Metrics()
+
+        # Routes shared by every car, keyed by (start, destination)
+        self.route_cache = RouteCache()
+
+        # Character map indexed [y, x], cell type and direction arrays, street graph and distance fields,
+        # compiled once per map and memory-mapped from the cache afterwards
+        compiled_map = load_compiled_map(f"../TrafficVisualization/{map_path}", dataDictionary)
+        self.map_hash = compiled_map.key
+        chars = compiled_map.chars
+        self.height, self.width = chars.shape
+        self.cell_types, self.directions = compiled_map.cell_types, compiled_map.directions
+
+        # Static cell type and direction, light state and car count per cell, kept in sync by the grid
+        self.layers = CellLayers(self.cell_types, self.directions)
+        self.grid = LayeredGrid(self.width, self.height, False, self.layers)
+        # Only cars are activated, traffic lights are scheduled asleep
+        self.schedule = ActiveSetActivation(self)
+
+        for r, row in enumerate(chars[::-1].tolist()):
+            for c, col in enumerate(row):
+                if col in ["v", "^", ">", "<"]:
+                    agent = Road_Agent(f"r_{r*self.width+c}", self, dataDictionary[col])
+                    self.grid.place_agent(agent, (c, self.height - r - 1))
+                elif col in ["S", "s"]:
+                    agent = Traffic_Light_Agent(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(dataDictionary[col]))
+                    self.grid.place_agent(agent, (c, self.height - r - 1))
+                    self.schedule.add(agent)
+                    # Additionally, add a road agent with same direction as road before traffic light
+
+                elif col == "#":
+                    agent = Building_Agent(f"ob_{r*self.width+c}", self)
+                    self.grid.place_agent(agent, (c, self.height - r - 1))
+                elif col == "D":
+                    agent = Destination_Agent(f"d_{r*self.width+c}", self)
+                    self.grid.place_agent(agent, (c, self.height - r - 1))
+                    # self.destinations.append((c, self.height - r - 1))
+                elif col == "z":
+                    agent = Car_Spawner_Agent(f"cs_{r*self.width+c}", self)
+                    self.grid.place_agent(agent, (c, self.height - r - 1))
+
+        self.road_graph = compiled_map.road_graph
+        # Distance/next-hop table towards every destination, shared by every car heading there
+        self.distance_fields = compiled_map.distance_fields
+        # Every cached route was computed from the previous tables
+        self.invalidate_routes()
+        # Live-weighted view of the graph, used by cars to repair their routes when blocked
+        self.planner = WeightedGraph(self)
+
+        # Agents of this model by type, so step() never has to scan the grid
+        self.index = AgentIndex()
+
+        # Loop through all agents and add them to the index
         for agents, x, y in self.grid.coord_iter():
             for agent in agents:
-                if isinstance(agent, Road_Agent):
-                    roads[agent.unique_id] = agent
-                elif isinstance(agent, Building_Agent):
-                    buildings[agent.unique_id] = agent
-                elif isinstance(agent, Car_Agent):
-                    cars[agent.unique_id] = agent
-                elif isinstance(agent, Traffic_Light_Agent):
-                    traffic_lights[agent.unique_id] = agent
-                elif isinstance(agent, Destination_Agent):
-                    destinations[agent.unique_id] = agent
-                elif isinstance(agent, Car_Spawner_Agent):
-                    spawners[agent.unique_id] = agent
-                    
+                self.index.add(agent)
+
+        # Registries of this model, live {unique_id: agent} views of the index
+        self.roads = self.index.of_type(Road_Agent)
+        self.buildings = self.index.of_type(Building_Agent)
+        self.cars = self.index.of_type(Car_Agent)
+        self.traffic_lights = self.index.of_type(Traffic_Light_Agent)
+        self.destinations = self.index.of_type(Destination_Agent)
+        self.spawners = self.index.of_type(Car_Spawner_Agent)
+
+        # Batched engine mode keeps cars in arrays instead of agents
+        self.car_engine = BatchedCarEngine(self) if engine == "batched" else None
+        # Decides which traffic lights are green
+        self.signals = SignalController(self, signals)
+        # Cars that reached their destination during the last step, retired at the start of the next one
+        self.arrived = []
+
         self.running = True
 
-    def generate_graph(self):
-        # Generate a graph of the streets
-        # self.graph = {}    # Generate graph dictionary
-        for agents, x, y in self.grid.coord_iter():   # Iterate through all agents
-            for agent in agents:
-                if isinstance(agent, Road_Agent) or isinstance(agent, Traffic_Light_Agent) or isinstance(agent, Car_Spawner_Agent) or isinstance(agent, Destination_Agent):
-                    # Check neighbors depending on the direction of the road
-
-                    # Get grid width and height values
-                    gridWidth = self.grid.width - 1
-                    gridHeight = self.grid.height - 1
-
-                    n_up = None
-                    n_ul = None
-                    n_ur = None
-                    n_left = None
-                    n_right = None
-                    n_down = None
-                    n_dr = None
-                    n_dl = None
-
-                    # Check if the agents neighbors are not out of bounds
-
-                    if (not x+1 > gridWidth) and (not y+1 > gridHeight):
-                        n_ur = self.grid.get_cell_list_contents((x+1, y+1))[0]
-                    if (not x-1 < 0) and (not y+1 > gridHeight):
-                        n_ul = self.grid.get_cell_list_contents((x-1, y+1))[0]
-                    if (not x+1 > gridWidth) and (not y-1 < 0):
-                        n_dr = self.grid.get_cell_list_contents((x+1, y-1))[0]
-                    if (not x-1 < 0) and (not y-1 < 0):
-                        n_dl = self.grid.get_cell_list_contents((x-1, y-1))[0]
-                    if not x+1 > gridWidth:
-                        n_right = self.grid.get_cell_list_contents((x+1, y))[0]
-                    if not x-1 < 0:
-                        n_left = self.grid.get_cell_list_contents((x-1, y))[0]
-                    if not y+1 > gridHeight:
-                        n_up = self.grid.get_cell_list_contents((x, y+1))[0]
-                    if not y-1 < 0:
-                        n_down = self.grid.get_cell_list_contents((x, y-1))[0]
-
-                    # Check if coordinate contains a road or a traffic light, and generate their neighbors
-
-                    if isinstance(agent, Road_Agent):
-                        # print(f"Road: {agent.unique_id} Direction: {agent.direction}")
-                        if(agent.direction == "Up"):   
-                            neighbors = [n_left, n_ul, n_up, n_ur, n_right]
-                        elif(agent.direction == "Right"):
-                            neighbors = [n_up, n_ur, n_right, n_dr, n_down]
-                        elif(agent.direction == "Down"):
-                            neighbors = [n_right, n_dr, n_down, n_dl, n_left]
-                        elif(agent.direction == "Left"):
-                            neighbors = [n_down, n_dl, n_left, n_ul, n_up]
-
-                    elif isinstance(agent, Traffic_Light_Agent):
-                        #Check that relative neighbors are roads
-                        if n_down != None:
-                            if isinstance(n_down, Road_Agent):
-                                if n_down.direction == "Up":
-                                    # print("facing up")
-                                    neighbors = [n_left, n_ul, n_up, n_ur, n_right]
-                        if n_left != None:
-                            if isinstance(n_left, Road_Agent): 
-                                if n_left.direction == "Right":
-                                    # print("facing right")
-                                    neighbors = [n_up, n_ur, n_right, n_dr, n_down]
-                        if n_up != None:
-                            if isinstance(n_up, Road_Agent):
-                                if n_up.direction == "Down":
-                                    # print("facing down")
-                                    neighbors = [n_right, n_dr, n_down, n_dl, n_left]
-                        if n_right != None:
-                            if isinstance(n_right, Road_Agent):
-                                if n_right.direction == "Left":
-                                    # print("facing left")
-                                    neighbors = [n_down, n_dl, n_left, n_ul, n_up]
-
-                    elif isinstance(agent, Car_Spawner_Agent):
-                        neighbors = []
-                        if n_up != None:
-                            if isinstance(n_up, Road_Agent):
-                                neighbors.append(n_up)
-                        if n_right != None:
-                            if isinstance(n_right, Road_Agent):
-                                neighbors.append(n_right)
-                        if n_down != None: 
-                            if isinstance(n_down, Road_Agent):
-                                neighbors.append(n_down)
-                        if n_left != None:
-                            if isinstance(n_left, Road_Agent):
-                                neighbors.append(n_left)
-
-                    new_neighbors = []
-                    # Filter out neighbors that are not roads or destinations, or if they are roads pointing towards the current road
-                    for neighbor in neighbors:
-                        if neighbor != None:
-                            
-                            # print(neighbor.unique_id)
-                            if isinstance(neighbor, Road_Agent):
-                                if isinstance(agent, Car_Spawner_Agent):
-                                    if neighbor == n_up or neighbor == n_right or neighbor == n_down or neighbor == n_left:
-                                        new_neighbors.append(neighbor.pos)
-                                # If it is any of the given 4 adjacent cells, and it doesn't point at me, include it.
-                                elif (neighbor == n_up and (neighbor.direction == "Left" or neighbor.direction == "Up" or neighbor.direction == "Right")) or (neighbor == n_right and (neighbor.direction == "Up" or neighbor.direction == "Right" or neighbor.direction == "Down")) or (neighbor == n_down and (neighbor.direction == "Right" or neighbor.direction == "Down" or neighbor.direction == "Left")) or (neighbor == n_left and (neighbor.direction == "Down" or neighbor.direction == "Left" or neighbor.direction == "Up")):
-                                    # print(f"    I can go to {neighbor.unique_id}!")
-                                    new_neighbors.append(neighbor.pos)
-                                # If any of the 4 diagonals points outwards, include it
-                                elif (neighbor == n_ur and (neighbor.direction == "Up" or neighbor.direction == "Right")) or (neighbor == n_dr and (neighbor.direction == "Right" or neighbor.direction == "Down")) or (neighbor == n_dl and (neighbor.direction == "Down" or neighbor.direction == "Left")) or (neighbor == n_ul and (neighbor.direction == "Left" or neighbor.direction == "Up")):
-                                    # print(f"    I can go to {neighbor.unique_id}!")     
-                                    new_neighbors.append(neighbor.pos)
-
-                            elif isinstance(neighbor, Traffic_Light_Agent) or isinstance(neighbor, Destination_Agent):
-                                if not isinstance(agent, Traffic_Light_Agent) and not isinstance(agent, Destination_Agent):
-                                    if agent.direction == "Up" or agent.direction == "Down":
-                                        if not (neighbor == n_right or neighbor == n_left):
-                                            # print(f"    I can go to {neighbor.unique_id}")
-                                            new_neighbors.append(neighbor.pos)
-                                    elif agent.direction == "Left" or agent.direction == "Right":
-                                        if not(neighbor == n_up or neighbor == n_down):
-                                            # print(f"    I can go to {neighbor.unique_id}")
-                                            new_neighbors.append(neighbor.pos)
-                                    else:
-                                        # print(f"    I can go to {neighbor.unique_id}")
-                                        new_neighbors.append(neighbor.pos)
-                            # else:
-                            #     print(f"    I can't go to a {neighbor.unique_id}")
-                    # Add the current agent to the dictionary with its id as the key and its neighbors as the value        
-                    self.coord_graph[str(agent.pos)] = new_neighbors
-
-        print("> Finished generating graph.")
-        # self.print_graph()
-        # return self.coord_graph
+    def invalidate_routes(self):
+        # Call whenever road topology or edge weights change, so cars stop reusing stale routes
+        self.route_cache.invalidate()
+
+    def next_hop(self, pos, destination_pos):
+        # Next cell on a shortest path from pos to the destination, None if there is none
+        field = self.distance_fields.get(destination_pos)
+        if field is None:
+            return None
+        node = field[1][self.road_graph.node(pos)]
+        return self.road_graph.position(int(node)) if node != -1 else None
+
+    def route_to(self, pos, destination_pos):
+        # Follow the next-hop table from pos to the destination, returns None if no table or path exists
+        field = self.distance_fields.get(destination_pos)
+        if field is None or pos == destination_pos:
+            return None
+        node = self.road_graph.node(pos)
+        if field[0][node] == -1:
+            return None
+        next_hop = field[1]
+        goal = self.road_graph.node(destination_pos)
+        path = [pos]
+        while node != goal:
+            node = int(next_hop[node])
+            path.append(self.road_graph.position(node))
+        return path
 
     def print_graph(self):
-        for key, value in self.coord_graph.items():
-            neighbors = ""
-            for neighbor in value:
-                if neighbor != None:
-                    neighbors += f"{neighbor} "
-            print(f"+ Cell: {key} -> Neighbors: {neighbors}")
+        for node in range(self.width * self.height):
+            if self.road_graph.road_mask[node]:
+                neighbors = ""
+                for neighbor in self.road_graph.neighbors(node):
+                    neighbors += f"{self.road_graph.position(neighbor)} "
+                print(f"+ Cell: {self.road_graph.position(node)} -> Neighbors: {neighbors}")
 
     def step(self):
         '''Advance the model by one step.'''
-        self.schedule.step()
-        # Get total number of cars spawned and total number of arrived cars
-        total_cars_spawned = 0
-        total_arrivals = 0
-        # cars_circulating = 0
-        for spawner in spawners.values():
-            total_cars_spawned += spawner.spawned
-        for destination in destinations.values():
-            total_arrivals += destination.arrivals
-        # Count cars with at_destination == False
-        # for car in cars.values():
-        #     if not car.at_destination:
-        #         cars_circulating += 1
-        print(f"Cars spawned: {total_cars_spawned}")
-        # print(f"Currently circulating: {cars_circulating}")
-        print(f"Total arrivals: {total_arrivals}")
-        for agents, x, y in self.grid.coord_iter():
-            for agent in agents:
-                if self.schedule.steps % 2 == 0: # and len(cars) < self.num_agents:
-                    if isinstance(agent, Car_Spawner_Agent):
-                        car = agent.spawn_car()
-                        if car != None:
-                            car.destination = self.random.choice(list(destinations.values()))
-                            car.path = car.calculate_route()
-                            cars[car.unique_id] = car
-                        else:
-                            print(f"Spawner {agent.unique_id} is jammed.")
-        if self.schedule.steps % 10 == 0:
-            for agents, x, y in self.grid.coord_iter():
-                for agent in agents:
-                    if isinstance(agent, Traffic_Light_Agent):
-                        agent.state = not agent.state
\ No newline at end of file
+        with self.metrics.time("step"):
+            self.retire_arrived()
+            with self.metrics.time("schedule_step"):
+                self.schedule.step()
+            if self.car_engine != None:
+                with self.metrics.time("engine_step"):
+                    self.car_engine.step()
+            # Get total number of cars spawned and total number of arrived cars, only if anyone is listening
+            if log.isEnabledFor(logging.DEBUG):
+                total_cars_spawned = 0
+                total_arrivals = 0
+                # cars_circulating = 0
+                for spawner in self.spawners.values():
+                    total_cars_spawned += spawner.spawned
+                for destination in self.destinations.values():
+                    total_arrivals += destination.arrivals
+                # Count cars with at_destination == False
+                # for car in cars.values():
+                #     if not car.at_destination:
+                #         cars_circulating += 1
+                log.debug("Cars spawned: %s", total_cars_spawned)
+                # log.debug("Currently circulating: %s", cars_circulating)
+                log.debug("Total arrivals: %s", total_arrivals)
+            if self.schedule.steps % self.spawn_interval == 0: # and len(cars) < self.num_agents:
+                with self.metrics.time("spawning"):
+                    self.spawn_cars()
+            with self.metrics.time("light_toggle"):
+                self.signals.step()
+
+    def spawn_cars(self):
+        destination_list = list(self.destinations.values())
+        for spawner in self.spawners.values():
+            self.spawn_attempts += 1
+            if self.car_engine != None:
+                # Destination drawn before spawning, the engine needs it to place the car
+                if self.car_engine.spawn(spawner, self.random.choice(destination_list)) == None:
+                    self.spawns_jammed += 1
+                    self.metrics.count("spawns_jammed")
+                    log.debug("Spawner %s is jammed.", spawner.unique_id)
+                continue
+            car = spawner.spawn_car()
+            if car != None:
+                car.destination = self.random.choice(destination_list)
+                car.follow(car.calculate_route())
+                self.index.add(car)
+            else:
+                self.spawns_jammed += 1
+                self.metrics.count("spawns_jammed")
+                log.debug("Spawner %s is jammed.", spawner.unique_id)
+
+    def retire_arrived(self):
+        # Take arrived cars off the grid and out of the registries, so a long run doesn't keep every car it
+        # ever spawned
+        if self.car_engine != None:
+            self.car_engine.retire()
+            return
+        for car in self.arrived:
+            self.grid.remove_agent(car)
+            self.index.remove(car)
+        self.metrics.count("cars_retired", len(self.arrived))
+        self.arrived = []
+
+    def checkpoint(self):
+        """
+        Full dynamic state of the model as compact checkpoint bytes, see checkpoint.py.
+        """
+        return save_checkpoint(self)
+
+    @classmethod
+    def from_checkpoint(cls, data):
+        """
+        Builds a model of the checkpoint's map and restores its state. Raises ValueError for anything that
+        isn't a checkpoint this version can restore.
+        """
+        header, arrays = read_checkpoint(data)
+        model = cls(header["map_path"], header["engine"], spawn_interval=header["spawn_interval"],
+                    light_period=header["light_period"], signals=header["signals"])
+        load_checkpoint(model, header, arrays)
+        return model
+
+    def reseed(self, seed):
+        # New random streams from here on, e.g. for runs branching from the same checkpoint
+        self.reset_randomizer(seed)
+        if self.car_engine != None:
+            self.car_engine.rng = np.random.default_rng(self.random.getrandbits(64))
+
+    def close(self):
+        # Nothing to release, see ShardedModel for a model that runs in other processes
+        pass
+
+    def next_car_number(self):
+        self.cars_created += 1
+        return self.cars_created - 1
+
+    def car_count(self):
+        # Number of cars on the map, in either engine mode
+        if self.car_engine != None:
+            return self.car_engine.count
+        return len(self.cars)
+
+    def car_state(self):
+        """
+        Ids, positions and flags of every car as parallel arrays, in either engine mode.
+        """
+        if self.car_engine != None:
+            return self.car_engine.car_state()
+        cars = list(self.cars.values())
+        return {
+            "ids": np.array([car.unique_id for car in cars], dtype=np.int64),
+            "x": np.array([car.pos[0] for car in cars], dtype=np.int32),
+            "y": np.array([car.pos[1] for car in cars], dtype=np.int32),
+            "in_traffic": np.array([car.in_traffic for car in cars], dtype=bool),
+            "at_destination": np.array([car.at_destination for car in cars], dtype=bool),
+        }
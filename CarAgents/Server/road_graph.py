@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class RoadGraph:
+    """
+    Street graph compiled into compressed sparse row (CSR) arrays.
+    Every grid cell is a node with index y * width + x, the cells a car can move to from node n
+    are indices[indptr[n]:indptr[n + 1]], in the same order generate_graph found them.
+    """
+    def __init__(self, width, height, indptr, indices, road_mask):
+        self.width = width
+        self.height = height
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        # True for every cell that is part of the street graph (roads, lights, spawners, destinations)
+        self.road_mask = np.asarray(road_mask, dtype=bool)
+
+        # Plain lists for the per-node lookups in the search loops, indexing numpy one element at a time is slower
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+
+    @classmethod
+    def from_adjacency(cls, width, height, adjacency):
+        """
+        Compiles a {(x, y): [(x, y), ...]} adjacency dictionary into CSR arrays.
+        """
+        size = width * height
+        counts = np.zeros(size, dtype=np.int32)
+        road_mask = np.zeros(size, dtype=bool)
+        for (x, y), neighbors in adjacency.items():
+            counts[y * width + x] = len(neighbors)
+            road_mask[y * width + x] = True
+
+        indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(counts, out=indptr[1:])
+
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        for (x, y), neighbors in adjacency.items():
+            start = indptr[y * width + x]
+            for offset, (nx, ny) in enumerate(neighbors):
+                indices[start + offset] = ny * width + nx
+
+        return cls(width, height, indptr, indices, road_mask)
+
+    def node(self, pos):
+        return pos[1] * self.width + pos[0]
+
+    def position(self, node):
+        return (node % self.width, node // self.width)
+
+    def neighbors(self, node):
+        return self._indices[self._indptr[node]:self._indptr[node + 1]]
+
+    def neighbor_positions(self, pos):
+        return [self.position(neighbor) for neighbor in self.neighbors(self.node(pos))]
+
+    def reverse(self):
+        """
+        Returns the graph with every edge flipped, used to search backwards from a goal.
+        """
+        sources = np.repeat(np.arange(self.width * self.height, dtype=np.int32), np.diff(self.indptr))
+        # Stable sort keeps predecessors in the order they appear in the forward graph
+        order = np.argsort(self.indices, kind="stable")
+        counts = np.bincount(self.indices, minlength=self.width * self.height)
+
+        indptr = np.zeros(self.width * self.height + 1, dtype=np.int32)
+        np.cumsum(counts, out=indptr[1:])
+
+        return RoadGraph(self.width, self.height, indptr, sources[order], self.road_mask)
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+
+class RouteCache:
+    """
+    Bounded LRU cache of routes shared by all the cars of a model, keyed by (start, destination).
+    Every entry remembers the graph version it was computed on, and is ignored once the version changes.
+    Args:
+        max_entries: Maximum number of routes kept
+        max_nodes: Memory budget, maximum number of cells kept across all routes
+    """
+    def __init__(self, max_entries=4096, max_nodes=262144):
+        self.routes = OrderedDict()
+        self.max_entries = max_entries
+        self.max_nodes = max_nodes
+        self.version = 0
+        self.nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, start, destination):
+        """
+        Returns the cached route as a tuple of cells, or None on a miss.
+        """
+        key = (start, destination)
+        entry = self.routes.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        version, route = entry
+        if version != self.version:
+            # Computed on an older graph, drop it
+            self.discard(key)
+            self.misses += 1
+            return None
+
+        self.routes.move_to_end(key)
+        self.hits += 1
+        return route
+
+    def put(self, start, destination, route):
+        route = tuple(route)
+        # A route larger than the whole budget would just evict everything else
+        if len(route) > self.max_nodes:
+            return route
+
+        key = (start, destination)
+        self.discard(key)
+        self.routes[key] = (self.version, route)
+        self.nodes += len(route)
+
+        # Evict least recently used routes until the cache fits its budget again
+        while len(self.routes) > self.max_entries or self.nodes > self.max_nodes:
+            _, (_, evicted) = self.routes.popitem(last=False)
+            self.nodes -= len(evicted)
+            self.evictions += 1
+
+        return route
+
+    def discard(self, key):
+        entry = self.routes.pop(key, None)
+        if entry is not None:
+            self.nodes -= len(entry[1])
+
+    def invalidate(self):
+        """
+        Bumps the graph version, every route cached so far becomes stale.
+        """
+        self.version += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.routes),
+            "nodes": self.nodes,
+            "version": self.version,
+        }
@@ -0,0 +1,59 @@
+"""
+Scheduler that only activates the agents with something to do. Static agents (traffic lights, obstacles,
+depots...) stay in the schedule so they are still counted and listed, but asleep: they are neither
+shuffled nor stepped, so a tick costs in proportion to the moving agents only.
+"""
+from mesa.time import RandomActivation
+
+
+class ActiveSetActivation(RandomActivation):
+    """
+    RandomActivation over the awake agents only. Awake agents are activated once per step in a fresh random
+    order, like RandomActivation does with every agent; asleep agents are skipped until woken.
+    An agent starts asleep if its class sets passive = True, awake otherwise, unless add() is told otherwise.
+    Agents put to sleep during a step are skipped for the rest of it, agents woken during a step act from
+    the next one.
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        # Awake agents by unique_id, in the order they woke up
+        self._awake = {}
+
+    def add(self, agent, awake=None):
+        super().add(agent)
+        if awake is None:
+            awake = not getattr(agent, "passive", False)
+        if awake:
+            self._awake[agent.unique_id] = agent
+
+    def remove(self, agent):
+        super().remove(agent)
+        self._awake.pop(agent.unique_id, None)
+
+    def wake(self, agent):
+        # No-op for agents already awake or not in the schedule
+        if agent.unique_id in self._agents:
+            self._awake.setdefault(agent.unique_id, agent)
+
+    def sleep(self, agent):
+        self._awake.pop(agent.unique_id, None)
+
+    def is_awake(self, agent):
+        return agent.unique_id in self._awake
+
+    @property
+    def awake_agents(self):
+        return list(self._awake.values())
+
+    def get_awake_count(self):
+        return len(self._awake)
+
+    def agent_buffer(self, shuffled=False):
+        # Same as BaseScheduler's, over the awake agents: copied first so agents can sleep, wake, come and go
+        # while the step runs
+        agent_keys = list(self._awake.keys())
+        if shuffled:
+            self.model.random.shuffle(agent_keys)
+        for agent_key in agent_keys:
+            if agent_key in self._awake:
+                yield self._awake[agent_key]
@@ -0,0 +1,222 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from frames import FrameLog, capture_frame
+from worker import StepWorker
+from metrics import Metrics
+from checkpoint import CheckpointUnavailable
+
+
+class Session:
+    """
+    One simulation hosted by the server. The lock must be held while the session is read or stepped, since
+    Flask serves requests from several threads.
+    With prefetch > 0 a StepWorker simulates up to that many steps ahead in the background, stepping the
+    session then only takes the next precomputed frame. Either way, cars, lights and counters should be read
+    from self.frame, the state at current_step.
+    A TrajectoryRecorder, if given, gets the frame of every step the session goes through.
+    """
+    def __init__(self, session_id, model, prefetch=0, recorder=None):
+        self.id = session_id
+        self.model = model
+        # Restored models start where their checkpoint was taken
+        self.current_step = model.schedule.steps
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        # Recent changes, for clients asking for /state since their last step
+        self.frame_log = FrameLog()
+        self.frame = capture_frame(model, self.current_step)
+        self.frame_log.record(self.frame)
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.append(self.frame)
+        # Pushes frames to streaming clients, created by the first subscriber
+        self.stream = None
+        self.worker = StepWorker(model, self.current_step, prefetch, recorder) if prefetch > 0 else None
+
+    def step(self):
+        self.advance(1)
+
+    def advance(self, steps):
+        """
+        Moves the session steps steps forward. Only the last frame is captured and logged, clients never saw
+        the ones in between, so fast-forwarding a long warm-up costs little more than the model steps.
+        """
+        if steps < 1:
+            return
+        if self.worker is not None:
+            frame = self.worker.take(steps)
+        elif self.recorder is not None:
+            # A recording needs every step, not just the last one
+            for step in range(self.current_step + 1, self.current_step + steps + 1):
+                self.model.step()
+                frame = capture_frame(self.model, step)
+                self.recorder.append(frame)
+        else:
+            for _ in range(steps):
+                self.model.step()
+            frame = capture_frame(self.model, self.current_step + steps)
+        self.current_step = frame.step
+        self.frame = frame
+        self.frame_log.record(frame)
+
+    def checkpoint(self):
+        """
+        Returns a checkpoint of the model and the step it was taken at. With a StepWorker the model is ahead
+        of current_step, up to prefetch steps: the checkpoint is of the worker's latest step.
+        """
+        if self.worker is None:
+            return self.model.checkpoint(), self.model.schedule.steps
+        with self.worker.model_lock:
+            return self.model.checkpoint(), self.model.schedule.steps
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+        if self.worker is not None:
+            self.worker.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.model.close()
+
+    def cost(self):
+        # Rough memory footprint: one agent per map cell plus one per car
+        return self.model.width * self.model.height + self.model.car_count()
+
+
+class ReplaySession(Session):
+    """
+    Session serving a recording instead of a simulation. Stepping moves through the recorded frames and
+    seek() jumps to any recorded step; the model is only there for the static layers of the map and is
+    never stepped.
+    """
+    def __init__(self, session_id, model, trajectory):
+        self.id = session_id
+        self.model = model
+        self.trajectory = trajectory
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.stream = None
+        self.worker = None
+        self.recorder = None
+        self.frame_log = FrameLog()
+        self.current_step = None
+        self.seek(trajectory.first_step())
+
+    def advance(self, steps):
+        if steps < 1:
+            return
+        if self.current_step + steps > self.trajectory.last_step():
+            # The recording may still be growing
+            self.trajectory.reload()
+        self.seek(self.current_step + steps)
+
+    def seek(self, step):
+        """
+        Jumps to the recorded step closest to step, without going past it. Clients asking for changes since
+        a step they saw before a jump back get a full snapshot.
+        """
+        step = self.trajectory.nearest(step)
+        if self.current_step is not None and step < self.current_step:
+            self.frame_log = FrameLog()
+        self.current_step = step
+        self.frame = self.trajectory.frame(step)
+        self.frame_log.record(self.frame)
+
+    def checkpoint(self):
+        raise CheckpointUnavailable("Replays have no model state to checkpoint")
+
+    def cost(self):
+        return self.model.width * self.model.height
+
+
+class SessionRegistry:
+    """
+    Simulations hosted by one server process, by session id. Sessions idle for longer than ttl seconds are
+    evicted, and the least recently used ones are evicted when there are more than max_sessions or their
+    combined cost goes over max_cost.
+    """
+    def __init__(self, ttl=1800, max_sessions=32, max_cost=20_000_000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_cost = max_cost
+        self.sessions = OrderedDict()
+        # Session that get() returns when no id is given
+        self.latest_id = None
+        self.lock = threading.Lock()
+        # Metrics of the sessions that are gone, so the server's totals never go down
+        self.retired_metrics = Metrics()
+
+    def create(self, model, prefetch=0, recorder=None):
+        return self.add(Session(uuid.uuid4().hex, model, prefetch, recorder))
+
+    def replay(self, model, trajectory):
+        return self.add(ReplaySession(uuid.uuid4().hex, model, trajectory))
+
+    def add(self, session):
+        with self.lock:
+            self.sessions[session.id] = session
+            self.latest_id = session.id
+            self.evict(keep=session.id)
+        return session
+
+    def get(self, session_id=None):
+        """
+        Returns the session with session_id, or the most recently created one if no id is given.
+        None if there is no such session (never created, or evicted).
+        """
+        with self.lock:
+            self.evict()
+            if session_id is None:
+                session_id = self.latest_id
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self.retire(session)
+        return True
+
+    def retire(self, session):
+        session.close()
+        self.retired_metrics.merge(session.model.metrics)
+
+    def metrics(self):
+        """
+        Metrics of every session, live or gone, added up.
+        """
+        total = Metrics()
+        total.merge(self.retired_metrics)
+        with self.lock:
+            live = list(self.sessions.values())
+        for session in live:
+            total.merge(session.model.metrics)
+        return total
+
+    def evict(self, keep=None):
+        now = time.monotonic()
+        for session_id in [sid for sid, session in self.sessions.items() if now - session.last_used > self.ttl]:
+            if session_id != keep:
+                self.retire(self.sessions.pop(session_id))
+
+        # Least recently used first, never the session that was just created
+        total_cost = sum(session.cost() for session in self.sessions.values())
+        for session_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions and total_cost <= self.max_cost:
+                break
+            if session_id != keep:
+                session = self.sessions.pop(session_id)
+                total_cost -= session.cost()
+                self.retire(session)
+
+    def __len__(self):
+        return len(self.sessions)
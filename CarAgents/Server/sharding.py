@@ -0,0 +1,325 @@
+"""
+Sharded simulation for maps too big for one core. The map is split into rectangular tiles and every tile
+is simulated by its own worker process, each with a batched-engine RandomModel of the whole map of which
+it only moves the cars on its own tile.
+
+Every tick runs in lockstep (the coordinator waits for every shard, which is the per-tick barrier):
+    1. The coordinator sends each shard the car counts of its halo, the cells of other tiles next to its
+       own, and the states of the other tiles' lights it can see, as they were at the end of the last
+       tick, plus the cars that drove onto its tile.
+    2. The shard adopts the incoming cars and steps its model.
+    3. Cars that ended the tick on another tile are released and sent back to the coordinator along with
+       the shard's cars, lights, counters and the cells on the edge of its tile.
+A car may move into a halo cell that a car of the neighbouring tile enters in the same tick, both then
+share the cell for a tick. Every intersection is decided by a single shard, the one owning its first
+light, even when a tile edge cuts through it; in actuated mode that shard's halo also covers the cells
+its queues are measured on.
+
+ShardedModel is a RandomModel (the static agents of the map, never stepped) whose cars, lights and
+counters are the aggregate of the shards, so the Flask getters and the batch runner use it like any model.
+"""
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from model import RandomModel
+from checkpoint import CheckpointUnavailable
+from metrics import Metrics
+from map_compiler import facing
+from signals import LEGACY, ACTUATED, group_lights, approach_cells
+
+
+def tile_owners(width, height, shards):
+    """
+    Tile of every cell, as an array indexed like the model's layers (y * width + x). The map is cut into
+    rows x columns tiles of about the same size, with more cuts along the longer side.
+    """
+    rows = max(divisor for divisor in range(1, int(shards ** 0.5) + 1) if shards % divisor == 0)
+    columns = shards // rows
+    if height > width:
+        rows, columns = columns, rows
+    tile_x = np.minimum(np.arange(width) * columns // width, columns - 1)
+    tile_y = np.minimum(np.arange(height) * rows // height, rows - 1)
+    return (tile_y[:, None] * columns + tile_x[None, :]).reshape(-1)
+
+
+def dilate(mask):
+    # Cells within one step (diagonals included) of a cell in mask
+    padded = np.pad(mask, 1)
+    height, width = mask.shape
+    grown = np.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            grown |= padded[dy:dy + height, dx:dx + width]
+    return grown
+
+
+def tile_edges(owners, width, height, shards, watched=None):
+    """
+    For every tile, the cells of other tiles a car on it can look at or move to plus the tile's cells in
+    watched[tile] if given (the halo), and the cells of the tile in any other tile's halo (the border).
+    Returns a list of (halo, border) arrays of cell indexes.
+    """
+    halos = []
+    for tile in range(shards):
+        owned = (owners == tile).reshape(height, width)
+        halo = (dilate(owned) & ~owned).reshape(-1)
+        if watched is not None:
+            halo[watched[tile]] = True
+            halo &= owners != tile
+        halos.append(halo)
+    needed = np.logical_or.reduce(halos)
+    return [(np.flatnonzero(halo), np.flatnonzero(needed & (owners == tile))) for tile, halo in enumerate(halos)]
+
+
+def light_tiles(lights, owners, width):
+    """
+    Tile deciding every light, in the order of lights: the tile of the first light of its intersection.
+    """
+    rows = {light.unique_id: row for row, light in enumerate(lights)}
+    tiles = np.zeros(len(lights), dtype=np.int64)
+    for phases in group_lights(lights):
+        group = [rows[light.unique_id] for phase in phases for light in phase.lights]
+        first = lights[min(group)]
+        tiles[group] = owners[first.pos[1] * width + first.pos[0]]
+    return tiles
+
+
+def queue_cells(model, lights, tiles, shards):
+    # Cells the actuated queues of every tile's lights are measured on
+    layers = model.layers
+    cell_facing = facing(model.cell_types, model.directions).reshape(-1)
+    cells = [[] for _ in range(shards)]
+    for light, tile in zip(lights, tiles.tolist()):
+        cells[tile].extend(cell for cell in approach_cells(layers, cell_facing, light.pos) if cell >= 0)
+    return [np.array(tile_cells, dtype=np.int64) for tile_cells in cells]
+
+
+def owned(agents, owners, width, tile):
+    # Agents standing on the tile, in registry order
+    return [agent for agent in agents.values() if owners[agent.pos[1] * width + agent.pos[0]] == tile]
+
+
+class Shard:
+    """
+    One tile's model, living in a worker process.
+    """
+    def __init__(self, config):
+        self.model = RandomModel(config["map"], "batched", seed=config["seed"], spawn_interval=config["spawn_interval"],
+                                 light_period=config["light_period"], signals=config["signals"])
+        model = self.model
+        self.tile = config["tile"]
+        self.owners = tile_owners(model.width, model.height, config["shards"])
+        self.halo, self.border = config["halo"], config["border"]
+
+        # Only this tile's spawners add cars, and its cars get ids no other shard gives out
+        model.spawners = {spawner.unique_id: spawner for spawner in owned(model.spawners, self.owners, model.width, self.tile)}
+        model.car_engine.next_id = self.tile
+        model.car_engine.id_stride = config["shards"]
+        # Only the intersections of this tile are decided here, the states of the others come from their shard
+        lights = list(model.traffic_lights.values())
+        deciding = {lights[row].unique_id for row in np.flatnonzero(config["light_tiles"] == self.tile).tolist()}
+        model.signals.intersections = [intersection for intersection in model.signals.intersections
+                                       if intersection.phases[0].lights[0].unique_id in deciding]
+        # Light states are read straight from the light layer
+        self.light_cells = np.array([model.layers.index(light.pos) for light in lights
+                                     if light.unique_id in deciding], dtype=np.int64)
+        self.foreign_lights = [lights[row] for row in config["foreign_lights"].tolist()]
+        # Agents of other tiles are stepped by their own shard
+        for agent in list(model.schedule.agents):
+            if agent.pos is not None and self.owners[agent.pos[1] * model.width + agent.pos[0]] != self.tile:
+                model.schedule.remove(agent)
+        self.destinations = list(model.destinations.values())
+
+    def step(self, halo_cars, foreign_lights, incoming):
+        model = self.model
+        engine = model.car_engine
+        layers = model.layers
+        layers.cars[self.halo] = halo_cars
+        for light, state in zip(self.foreign_lights, foreign_lights.tolist()):
+            light.state = state
+        if incoming is not None:
+            engine.adopt(incoming)
+
+        model.step()
+
+        # Reported before the cars that left are released, so the frame of this tick still has them
+        cars = engine.car_state()
+        leaving = np.flatnonzero(~engine.at_destination[:engine.count] & (self.owners[engine.node[:engine.count]] != self.tile))
+        outgoing = engine.release(leaving) if len(leaving) > 0 else None
+
+        metrics = model.metrics.snapshot()
+        # Every report carries the metrics of its tick only
+        model.metrics = Metrics()
+        return {
+            "cars": cars,
+            "outgoing": outgoing,
+            "border_cars": layers.cars[self.border],
+            "lights": layers.light[self.light_cells],
+            "spawned": [spawner.spawned for spawner in model.spawners.values()],
+            "arrivals": np.array([destination.arrivals for destination in self.destinations], dtype=np.int64),
+            "spawn_attempts": model.spawn_attempts,
+            "spawns_jammed": model.spawns_jammed,
+            "metrics": metrics,
+        }
+
+
+def run_shard(connection, config):
+    """
+    Worker process: builds the tile's Shard, then steps it for every message until it gets None.
+    Errors are sent back instead of a report, the coordinator raises them.
+    """
+    try:
+        shard = Shard(config)
+        connection.send(("ready", None))
+        while True:
+            message = connection.recv()
+            if message is None:
+                return
+            connection.send(("report", shard.step(*message)))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ShardedModel(RandomModel):
+    """
+    RandomModel simulated by shards worker processes, one per tile (see the module docstring). Cars always
+    move with the batched engine. Call close() to stop the workers.
+    Args:
+        map_path: Map file, relative to the TrafficVisualization project
+        shards: Number of tiles and worker processes
+        seed: Seed of the run, every shard gets its own seed derived from it
+        spawn_interval, light_period, signals: Same as RandomModel's
+    """
+    def __init__(self, map_path, shards, seed=None, spawn_interval=2, light_period=10, signals=LEGACY):
+        # The coordinator never steps, its own agents only hold the aggregated state
+        super().__init__(map_path, "agents", seed=seed, spawn_interval=spawn_interval, light_period=light_period,
+                         signals=signals)
+        self.shards = shards
+        self.owners = tile_owners(self.width, self.height, shards)
+        light_list = list(self.traffic_lights.values())
+        self.light_tiles = light_tiles(light_list, self.owners, self.width)
+        watched = queue_cells(self, light_list, self.light_tiles, shards) if signals == ACTUATED else None
+        self.edges = tile_edges(self.owners, self.width, self.height, shards, watched)
+        # Rows of the lights each tile decides, and of the other tiles' lights on its cells or its halo
+        self.lights = [np.flatnonzero(self.light_tiles == tile) for tile in range(shards)]
+        self.foreign_lights = []
+        light_cells = np.array([self.layers.index(light.pos) for light in light_list], dtype=np.int64)
+        for tile, (halo, _) in enumerate(self.edges):
+            visible = (self.owners[light_cells] == tile) | np.isin(light_cells, halo)
+            self.foreign_lights.append(np.flatnonzero(visible & (self.light_tiles != tile)))
+        self.light_list = light_list
+        self.tile_spawners = [owned(self.spawners, self.owners, self.width, tile) for tile in range(shards)]
+        self.destination_list = list(self.destinations.values())
+
+        # Car count of every border cell and state of every light, as of the end of the last tick
+        self.edge_cars = np.zeros(self.width * self.height, dtype=np.int32)
+        self.light_states = np.array([light.state for light in light_list], dtype=bool)
+        # Cars waiting to be adopted by each shard in the next tick
+        self.incoming = [None] * shards
+        self.state = RandomModel.car_state(self)
+
+        # Spawned rather than forked, the server and the step workers run threads
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for tile in range(shards):
+            halo, border = self.edges[tile]
+            config = {"map": map_path, "shards": shards, "tile": tile, "seed": None if seed is None else seed * shards + tile,
+                      "spawn_interval": spawn_interval, "light_period": light_period, "signals": signals,
+                      "halo": halo, "border": border, "light_tiles": self.light_tiles,
+                      "foreign_lights": self.foreign_lights[tile]}
+            connection, child = context.Pipe()
+            process = context.Process(target=run_shard, args=(child, config), name=f"shard-{tile}", daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        for connection in self.connections:
+            self.receive(connection)
+
+    def receive(self, connection):
+        try:
+            kind, payload = connection.recv()
+        except EOFError:
+            self.close()
+            raise RuntimeError("A shard worker exited unexpectedly")
+        if kind == "error":
+            self.close()
+            raise RuntimeError(f"A shard worker failed:\n{payload}")
+        return payload
+
+    def step(self):
+        '''Advance every shard by one step.'''
+        # The shards' own phase timers ("step" included) are merged into self.metrics with their reports
+        for tile, connection in enumerate(self.connections):
+            halo = self.edges[tile][0]
+            connection.send((self.edge_cars[halo], self.light_states[self.foreign_lights[tile]], self.incoming[tile]))
+        with self.metrics.time("shard_barrier"):
+            reports = [self.receive(connection) for connection in self.connections]
+        self.schedule.steps += 1
+
+        with self.metrics.time("shard_merge"):
+            self.merge(reports)
+
+    def merge(self, reports):
+        # Cars handed over between tiles, grouped by the tile they drove onto
+        leaving = [report["outgoing"] for report in reports if report["outgoing"] is not None]
+        self.incoming = [None] * self.shards
+        if leaving:
+            cars = {name: np.concatenate([batch[name] for batch in leaving]) for name in leaving[0]}
+            tiles = self.owners[cars["node"]]
+            for tile in np.unique(tiles).tolist():
+                self.incoming[tile] = {name: array[tiles == tile] for name, array in cars.items()}
+            self.metrics.count("cars_handed_off", len(tiles))
+
+        arrivals = np.zeros(len(self.destination_list), dtype=np.int64)
+        self.spawn_attempts = 0
+        self.spawns_jammed = 0
+        for tile, report in enumerate(reports):
+            border = self.edges[tile][1]
+            self.edge_cars[border] = report["border_cars"]
+            # Only the lights that flipped, setting every light of a big map each tick adds up
+            rows = self.lights[tile]
+            changed = report["lights"] != self.light_states[rows]
+            for row, state in zip(rows[changed].tolist(), report["lights"][changed].tolist()):
+                self.light_list[row].state = state
+            self.light_states[rows] = report["lights"]
+            for spawner, spawned in zip(self.tile_spawners[tile], report["spawned"]):
+                spawner.spawned = spawned
+            arrivals += report["arrivals"]
+            self.spawn_attempts += report["spawn_attempts"]
+            self.spawns_jammed += report["spawns_jammed"]
+            self.metrics.merge_snapshot(*report["metrics"])
+        for destination, count in zip(self.destination_list, arrivals.tolist()):
+            destination.arrivals = count
+
+        self.state = {name: np.concatenate([report["cars"][name] for report in reports]) for name in reports[0]["cars"]}
+
+    def checkpoint(self):
+        # The state lives in the shard processes, a checkpoint would need every shard's
+        raise CheckpointUnavailable("Sharded models can't be checkpointed")
+
+    def car_count(self):
+        return len(self.state["ids"])
+
+    def car_state(self):
+        return self.state
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
@@ -0,0 +1,188 @@
+import numpy as np
+
+from map_compiler import facing, ROAD, UP, RIGHT, DOWN, LEFT
+
+# Controller modes. "legacy" keeps flipping every light each light_period steps.
+LEGACY = "legacy"
+FIXED = "fixed"
+ACTUATED = "actuated"
+MODES = [LEGACY, FIXED, ACTUATED]
+
+# Lights closer than this (in cells, diagonals included) belong to the same intersection
+INTERSECTION_RADIUS = 2
+# Cells counted behind every light when measuring its queue
+QUEUE_DEPTH = 4
+# Shortest and longest green of an actuated phase
+MIN_GREEN = 3
+MAX_GREEN = 20
+
+# (dx, dy) a car moves by in each direction
+OFFSETS = {UP: (0, 1), RIGHT: (1, 0), DOWN: (0, -1), LEFT: (-1, 0)}
+
+
+class Phase:
+    """
+    Lights of an intersection that are green at the same time: the ones that start green ('s') or the ones
+    that start red ('S'). Green lasts the lights' timeToChange in fixed-time mode.
+    """
+    def __init__(self, lights, duration=None):
+        self.lights = lights
+        self.duration = duration if duration != None else max(light.timeToChange for light in lights)
+        # Rows of the controller's queue table that belong to this phase's lights
+        self.rows = []
+
+
+class Intersection:
+    """
+    Phases of one intersection, cycled in order, and how long the current one has been green.
+    An intersection with a single phase alternates it with an all-red phase of the same length, since the
+    conflicting approach has no light of its own.
+    """
+    def __init__(self, phases):
+        self.phases = phases
+        self.current = 0
+        self.elapsed = 0
+        if len(phases) == 1:
+            self.phases = phases + [Phase([], phases[0].duration)]
+
+    def switch(self, phase):
+        for light in self.phases[self.current].lights:
+            light.state = False
+        self.current = phase
+        self.elapsed = 0
+        for light in self.phases[phase].lights:
+            light.state = True
+
+
+class SignalController:
+    """
+    Groups the model's traffic lights into intersections and phases and decides which phase is green.
+    Fixed-time mode cycles the phases using the lights' timeToChange. Actuated mode keeps a phase green
+    while cars are queued behind it (between MIN_GREEN and MAX_GREEN steps) and skips to a waiting phase
+    as soon as its own queue is empty. Queues are read from the model's car occupancy layer, over a fixed
+    number of cells behind each light, so a step costs O(lights).
+    Args:
+        model: RandomModel with its layers and traffic lights registry built
+        mode: One of MODES
+    """
+    def __init__(self, model, mode=LEGACY):
+        if mode not in MODES:
+            raise ValueError(f"Unknown signal mode {mode}, expected one of {MODES}")
+        self.model = model
+        self.mode = mode
+        self.intersections = []
+        if mode == LEGACY:
+            return
+
+        layers = model.layers
+        lights = list(model.traffic_lights.values())
+        self.intersections = [Intersection(phases) for phases in group_lights(lights)]
+
+        # Cells behind every light, padded with -1, one row per light in the order of self.lights
+        self.lights = [light for intersection in self.intersections for phase in intersection.phases for light in phase.lights]
+        cell_facing = facing(model.cell_types, model.directions).reshape(-1)
+        self.approaches = np.full((len(self.lights), QUEUE_DEPTH), -1, dtype=np.int64)
+        row = 0
+        for intersection in self.intersections:
+            for phase in intersection.phases:
+                for light in phase.lights:
+                    self.approaches[row] = approach_cells(layers, cell_facing, light.pos)
+                    phase.rows.append(row)
+                    row += 1
+        # Padding cells are gathered as cell 0 and masked out of the sums
+        self.valid = self.approaches >= 0
+        self.cells = np.maximum(self.approaches, 0)
+
+        # Start every intersection on its first phase
+        for intersection in self.intersections:
+            for phase in intersection.phases:
+                for light in phase.lights:
+                    light.state = False
+            intersection.switch(0)
+
+    def queues(self):
+        """
+        Cars queued behind each light, in the order of self.lights.
+        """
+        return (self.model.layers.cars[self.cells] * self.valid).sum(axis=1)
+
+    def step(self):
+        if self.mode == LEGACY:
+            if self.model.schedule.steps % self.model.light_period == 0:
+                for light in self.model.traffic_lights.values():
+                    light.state = not light.state
+            return
+
+        queues = self.queues() if self.mode == ACTUATED else None
+        for intersection in self.intersections:
+            intersection.elapsed += 1
+            phase = intersection.phases[intersection.current]
+            following = (intersection.current + 1) % len(intersection.phases)
+
+            if self.mode == FIXED or not phase.lights or not intersection.phases[following].lights:
+                if intersection.elapsed >= phase.duration:
+                    intersection.switch(following)
+                continue
+
+            # Actuated: hold green for the queue behind it, hand over early if it's empty and others wait
+            if intersection.elapsed < MIN_GREEN:
+                continue
+            own_queue = queues[phase.rows].sum()
+            waiting = [queues[other.rows].sum() for other in intersection.phases]
+            waiting[intersection.current] = 0
+            if intersection.elapsed >= MAX_GREEN or (own_queue == 0 and max(waiting) > 0):
+                # Busiest waiting phase next, or simply the next one if nobody is waiting
+                busiest = int(np.argmax(waiting))
+                intersection.switch(busiest if waiting[busiest] > 0 else following)
+
+
+def group_lights(lights):
+    """
+    Splits lights into intersections (lights within INTERSECTION_RADIUS of each other) and every
+    intersection into phases by the lights' initial state. Returns a list of phase lists, green phase first.
+    """
+    by_position = {light.pos: light for light in lights}
+    seen = set()
+    intersections = []
+    for light in lights:
+        if light.pos in seen:
+            continue
+        # Flood fill over nearby lights
+        group = []
+        pending = [light.pos]
+        seen.add(light.pos)
+        while pending:
+            x, y = pending.pop()
+            group.append(by_position[(x, y)])
+            for dx in range(-INTERSECTION_RADIUS, INTERSECTION_RADIUS + 1):
+                for dy in range(-INTERSECTION_RADIUS, INTERSECTION_RADIUS + 1):
+                    neighbor = (x + dx, y + dy)
+                    if neighbor in by_position and neighbor not in seen:
+                        seen.add(neighbor)
+                        pending.append(neighbor)
+
+        green = [light for light in group if light.state]
+        red = [light for light in group if not light.state]
+        intersections.append([Phase(phase) for phase in [green, red] if phase])
+    return intersections
+
+
+def approach_cells(layers, cell_facing, pos):
+    """
+    Up to QUEUE_DEPTH road cells straight behind the light at pos, nearest first, -1 past the end of the road.
+    """
+    cells = [-1] * QUEUE_DEPTH
+    direction = cell_facing[layers.index(pos)]
+    if direction not in OFFSETS:
+        return cells
+    dx, dy = OFFSETS[direction]
+    x, y = pos
+    for i in range(QUEUE_DEPTH):
+        x, y = x - dx, y - dy
+        if not (0 <= x < layers.width and 0 <= y < layers.height):
+            break
+        cell = layers.index((x, y))
+        if layers.cell_type[cell] != ROAD:
+            break
+        cells[i] = cell
+    return cells
@@ -0,0 +1,40 @@
+import hashlib
+import json
+import threading
+
+
+class StaticLayer:
+    """
+    Serialized response body of a layer that never changes once a map is loaded, with a strong ETag derived
+    from the bytes. The payload is kept for responses that add live fields to the static ones.
+    """
+    def __init__(self, payload):
+        self.payload = payload
+        self.body = json.dumps(payload, separators=(",", ":")).encode()
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
+
+class StaticLayerCache:
+    """
+    StaticLayers by (map hash, layer name). Every session on the same map shares the same bytes, so a layer
+    is only serialized the first time any session asks for it.
+    """
+    def __init__(self):
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    def get(self, map_hash, name, build):
+        """
+        Cached layer, or the one serialized from build() (a JSON-serializable payload) on the first call.
+        """
+        key = (map_hash, name)
+        with self.lock:
+            layer = self.layers.get(key)
+        if layer is None:
+            layer = StaticLayer(build())
+            with self.lock:
+                layer = self.layers.setdefault(key, layer)
+        return layer
+
+    def __len__(self):
+        return len(self.layers)
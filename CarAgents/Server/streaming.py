@@ -0,0 +1,132 @@
+import base64
+import json
+import threading
+import time
+from collections import deque
+
+from encoding import encode_cars, encode_lights
+from logs import get_logger
+
+log = get_logger("stream")
+
+# Seconds a subscriber waits for a frame before sending a keep-alive comment
+KEEPALIVE = 15
+
+
+def frame_events(frame, width, format="json"):
+    """
+    Server-sent events for one frame. JSON frames are a single "frame" event with the cars and lights in the
+    layout of the getters; binary frames are a "cars" and a "lights" event with the base64 encoded frames of
+    encoding.py, since an event stream can only carry text.
+    """
+    if format == "binary":
+        cars = base64.b64encode(encode_cars(frame.step, frame.cars)).decode("ascii")
+        lights = base64.b64encode(encode_lights(frame.step, width, frame.light_x, frame.light_y, frame.light_states)).decode("ascii")
+        return f"id: {frame.step}\nevent: cars\ndata: {cars}\n\nid: {frame.step}\nevent: lights\ndata: {lights}\n\n"
+    data = json.dumps({"currentStep": frame.step, "cars": frame.car_data(), "lights": frame.light_data()})
+    return f"id: {frame.step}\nevent: frame\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """
+    Frames waiting to be sent to one client. Holds at most max_pending frames: when the client falls behind,
+    the oldest ones are dropped, so it always catches up to the latest state instead of lagging further.
+    max_pending=1 coalesces everything into the newest frame.
+    """
+    def __init__(self, max_pending=4):
+        self.frames = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def push(self, frame):
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def next(self, timeout=KEEPALIVE):
+        """
+        Oldest pending frame, or None if none arrived within timeout or the stream was closed.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames or self.closed, timeout)
+            if not self.frames:
+                return None
+            return self.frames.popleft()
+
+
+class FrameStream:
+    """
+    Steps a session on a background thread and pushes every new frame to its subscribers, instead of each
+    client polling /update and the getters. The thread runs while there is at least one subscriber.
+    Args:
+        session: Session to step
+        rate: Steps per second, 0 to step as fast as possible
+    """
+    def __init__(self, session, rate=0):
+        self.session = session
+        self.rate = rate
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, max_pending=4):
+        subscriber = Subscriber(max_pending)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f"stream-{self.session.id}", daemon=True)
+                self.thread.start()
+        # Start from the current state rather than waiting for the next step
+        subscriber.push(self.session.frame)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        subscriber.close()
+
+    def stop(self):
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def run(self):
+        while True:
+            started = time.monotonic()
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+                subscribers = list(self.subscribers)
+
+            try:
+                with self.session.lock:
+                    self.session.step()
+                    frame = self.session.frame
+            except Exception:
+                # Nothing more to stream: end every subscriber's response, the next subscribe starts over
+                log.exception("Stream of session %s stopped", self.session.id)
+                with self.lock:
+                    subscribers, self.subscribers = self.subscribers, []
+                    self.thread = None
+                for subscriber in subscribers:
+                    subscriber.close()
+                return
+            for subscriber in subscribers:
+                subscriber.push(frame)
+
+            if self.rate > 0:
+                time.sleep(max(0, 1 / self.rate - (time.monotonic() - started)))
+            else:
+                # Let request threads get the session lock between steps
+                time.sleep(0)
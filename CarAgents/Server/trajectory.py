@@ -0,0 +1,198 @@
+"""
+Recordings of a run, so it can be watched again without simulating it. A recording is a directory of
+append-only column files, little-endian, one value per car or per light after each step:
+    meta.json       map, size, and the ids and positions of the lights, spawners and destinations
+    index.bin       int64[steps, 3]: step, offset of its first car in the car columns, number of cars
+    car_ids.bin     int32 per car
+    car_x.bin       int16 per car
+    car_y.bin       int16 per car
+    car_flags.bin   uint8 per car, the bits of encoding.py
+    lights.bin      uint8[steps, lights], GREEN bit
+    spawned.bin     int64[steps, spawners]
+    arrivals.bin    int64[steps, destinations]
+The index row of a step is written after its data, so a reader never sees a step that is half written.
+Trajectory memory-maps the columns and rebuilds the Frame of any step without touching the rest.
+"""
+import json
+import os
+
+import numpy as np
+
+from encoding import IN_TRAFFIC, AT_DESTINATION, GREEN
+from frames import Frame
+
+# Recordings made and replayed by the server, one subdirectory each
+RECORDINGS_DIR = "recordings"
+
+# File and dtype of every column
+COLUMNS = {
+    "ids": ("car_ids.bin", "<i4"),
+    "x": ("car_x.bin", "<i2"),
+    "y": ("car_y.bin", "<i2"),
+    "flags": ("car_flags.bin", np.uint8),
+    "lights": ("lights.bin", np.uint8),
+    "spawned": ("spawned.bin", "<i8"),
+    "arrivals": ("arrivals.bin", "<i8"),
+}
+INDEX = ("index.bin", "<i8")
+
+
+class TrajectoryRecorder:
+    """
+    Appends the frames of a run to a new recording directory.
+    Args:
+        path: Directory to create, it must not exist yet
+        model: Model being recorded, for the map and the ids of its static agents
+        flush_every: Steps buffered before the files are flushed
+    """
+    def __init__(self, path, model, flush_every=32):
+        os.makedirs(path)
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        self.offset = 0
+        self.steps = 0
+
+        lights = list(model.traffic_lights.values())
+        meta = {
+            "map_path": model.map_path,
+            "map_hash": model.map_hash,
+            "width": model.width,
+            "height": model.height,
+            "light_ids": [light.unique_id for light in lights],
+            "light_x": [light.pos[0] for light in lights],
+            "light_y": [light.pos[1] for light in lights],
+            "spawner_ids": list(model.spawners),
+            "destination_ids": list(model.destinations),
+        }
+        with open(os.path.join(path, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+
+        self.files = {name: open(os.path.join(path, file_name), "wb") for name, (file_name, _) in COLUMNS.items()}
+        self.index = open(os.path.join(path, INDEX[0]), "wb")
+
+    def append(self, frame):
+        cars = frame.cars
+        count = len(cars["ids"])
+        flags = np.asarray(cars["in_traffic"], dtype=np.uint8) * IN_TRAFFIC \
+            | np.asarray(cars["at_destination"], dtype=np.uint8) * AT_DESTINATION
+        values = {
+            "ids": cars["ids"],
+            "x": cars["x"],
+            "y": cars["y"],
+            "flags": flags,
+            "lights": np.asarray(frame.light_states, dtype=np.uint8) * GREEN,
+            "spawned": list(frame.spawned.values()),
+            "arrivals": list(frame.arrivals.values()),
+        }
+        for name, (_, dtype) in COLUMNS.items():
+            self.files[name].write(np.asarray(values[name], dtype=dtype).tobytes())
+        self.index.write(np.array([frame.step, self.offset, count], dtype=INDEX[1]).tobytes())
+        self.offset += count
+        self.steps += 1
+
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Data before index, so the steps in the index are always complete
+        for column in self.files.values():
+            column.flush()
+        self.index.flush()
+        self.pending = 0
+
+    def close(self):
+        if self.index.closed:
+            return
+        self.flush()
+        for column in self.files.values():
+            column.close()
+        self.index.close()
+
+
+def map_column(path, dtype, width=None):
+    # Read-only memory map of a column, reshaped to one row per step when width is given. A row the writer
+    # hasn't finished is left out.
+    count = os.path.getsize(path) // np.dtype(dtype).itemsize
+    if width is not None:
+        count -= count % width
+    if count == 0:
+        column = np.zeros(0, dtype=dtype)
+    else:
+        column = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+    return column.reshape(-1, width) if width is not None else column
+
+
+class Trajectory:
+    """
+    Read-only view of a recording, with random access to the frame of any recorded step.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.light_x = np.array(self.meta["light_x"], dtype=np.int32)
+        self.light_y = np.array(self.meta["light_y"], dtype=np.int32)
+        self.reload()
+
+    def reload(self):
+        """
+        Maps the files again, picking up the steps appended since the last time.
+        """
+        widths = {"lights": len(self.meta["light_ids"]), "spawned": len(self.meta["spawner_ids"]),
+                  "arrivals": len(self.meta["destination_ids"])}
+        index = map_column(os.path.join(self.path, INDEX[0]), INDEX[1], 3)
+        self.columns = {}
+        for name, (file_name, dtype) in COLUMNS.items():
+            if widths.get(name) == 0:
+                # Nothing to store per step, e.g. a map without traffic lights
+                self.columns[name] = np.zeros((len(index), 0), dtype=dtype)
+            else:
+                self.columns[name] = map_column(os.path.join(self.path, file_name), dtype, widths.get(name))
+
+        # Only steps whose every column is on disk, the writer may be ahead of its last flush
+        complete = min([len(index)] + [len(self.columns[name]) for name in widths])
+        cars = min(len(self.columns[name]) for name in ["ids", "x", "y", "flags"])
+        while complete > 0 and index[complete - 1, 1] + index[complete - 1, 2] > cars:
+            complete -= 1
+        self.index = index[:complete]
+        self.steps = self.index[:, 0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def first_step(self):
+        return int(self.steps[0]) if len(self) else None
+
+    def last_step(self):
+        return int(self.steps[-1]) if len(self) else None
+
+    def nearest(self, step):
+        """
+        Recorded step closest to step without going past it, clamped to the recording.
+        """
+        position = int(np.searchsorted(self.steps, step, side="right")) - 1
+        return int(self.steps[min(max(position, 0), len(self) - 1)])
+
+    def frame(self, step):
+        """
+        Frame of a recorded step, KeyError if it wasn't recorded.
+        """
+        position = int(np.searchsorted(self.steps, step))
+        if position >= len(self) or self.steps[position] != step:
+            raise KeyError(step)
+        _, offset, count = self.index[position].tolist()
+        columns = self.columns
+        flags = np.array(columns["flags"][offset:offset + count])
+        cars = {
+            "ids": np.array(columns["ids"][offset:offset + count], dtype=np.int64),
+            "x": np.array(columns["x"][offset:offset + count], dtype=np.int32),
+            "y": np.array(columns["y"][offset:offset + count], dtype=np.int32),
+            "in_traffic": (flags & IN_TRAFFIC) != 0,
+            "at_destination": (flags & AT_DESTINATION) != 0,
+        }
+        light_states = (np.array(columns["lights"][position]) & GREEN) != 0
+        spawned = dict(zip(self.meta["spawner_ids"], columns["spawned"][position].tolist()))
+        arrivals = dict(zip(self.meta["destination_ids"], columns["arrivals"][position].tolist()))
+        return Frame(step, cars, self.meta["light_ids"], self.light_x, self.light_y, light_states, spawned, arrivals)
@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+
+from frames import capture_frame
+
+
+class StepWorker:
+    """
+    Simulates ahead of the client on a background thread. Frames of the steps already simulated wait in a
+    bounded buffer; the worker pauses while it is full and resumes as soon as the session takes a frame,
+    so the client never waits for a tick unless it asks for more than has been precomputed.
+    Only the worker touches the model's dynamic state after it starts, everything the getters serve comes
+    from the frames.
+    Args:
+        model: RandomModel to step
+        step: Number of the last step the model has already taken
+        capacity: Maximum number of frames simulated ahead
+        recorder: TrajectoryRecorder getting the frame of every step, or None
+    """
+    def __init__(self, model, step=0, capacity=32, recorder=None):
+        self.model = model
+        self.recorder = recorder
+        self.step = step
+        self.capacity = capacity
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.error = None
+        # Held while the model steps, so others can read the model between two steps
+        self.model_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="step-worker", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or len(self.frames) < self.capacity)
+                if self.stopped:
+                    return
+
+            try:
+                with self.model_lock:
+                    self.model.step()
+                    frame = capture_frame(self.model, self.step + 1)
+                if self.recorder is not None:
+                    self.recorder.append(frame)
+            except Exception as error:
+                # Raised again in the request that takes the next frame
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.step += 1
+                self.frames.append(frame)
+                self.condition.notify_all()
+
+    def take(self, count=1):
+        """
+        Removes the next count frames from the buffer and returns the last one, waiting for the worker if
+        it isn't that far ahead yet.
+        """
+        with self.condition:
+            for _ in range(count):
+                self.condition.wait_for(lambda: self.frames or self.error != None or self.stopped)
+                if not self.frames:
+                    if self.error != None:
+                        raise RuntimeError("The simulation stopped with an error") from self.error
+                    raise RuntimeError("The simulation was stopped")
+                frame = self.frames.popleft()
+                # Room for one more frame
+                self.condition.notify_all()
+            return frame
+
+    def buffered(self):
+        with self.condition:
+            return len(self.frames)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        # Let the step in progress finish, so the model can be closed safely afterwards
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
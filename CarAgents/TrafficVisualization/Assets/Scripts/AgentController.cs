@@ -356,6 +356,21 @@ public class AgentController : MonoBehaviour
                 }
                 carsSpawned++;
             }
+
+            // Remove the cars the server retired after they reached their destination
+            HashSet<string> activeCars = new HashSet<string>();
+            foreach(CarData car in carsData.data)
+                activeCars.Add(car.id);
+            foreach(string id in new List<string>(cars.Keys))
+            {
+                if(!activeCars.Contains(id))
+                {
+                    Destroy(cars[id]);
+                    cars.Remove(id);
+                    prevPositions.Remove(id);
+                    currPositions.Remove(id);
+                }
+            }
             Debug.Log("CARS SPAWNED: " + carsSpawned);
 
             updated = true;
@@ -15,14 +15,17 @@ the depot. The depot is a special cell that is always in the same position and c
 """
 import math
 from mesa import Agent, Model
-from mesa.time import RandomActivation
 from mesa.space import Grid
+from logs import get_logger
+from scheduler import ActiveSetActivation
 
 agents = {}
 depots = {}
 packages = {}
 # Global dictionaries with all existing agents, depots and packages
 
+log = get_logger("agents")
+
 class RandomAgent(Agent):
     """
     Agent that moves randomly.
@@ -60,7 +63,7 @@ class RandomAgent(Agent):
         Moves the agent to a package if in neighboring cells.
         If no package is found, the agent moves randomly.
         """
-        print(f"Agent {self.unique_id} is seeking a package at {self.pos}")
+        log.debug("Agent %s is seeking a package at %s", self.unique_id, self.pos)
         # print(f"Agent {self.unique_id} is seeking package")
         # Get the neighbors of the agent
         neighbors = self.model.grid.get_neighborhood(
@@ -76,7 +79,7 @@ class RandomAgent(Agent):
             if(len(content) > 0):
                 # print(f"Agent {self.unique_id} has found a {content[0].type_str} at {pos}")
                 if(content[0].type_str == "PKG"):
-                    print(f"Agent {self.unique_id} has picked up package {content[0].unique_id}")
+                    log.debug("Agent %s has picked up package %s", self.unique_id, content[0].unique_id)
                     self.model.grid.move_agent(self, pos)
                     self.has_package = True
                     content[0].pick_up()
@@ -89,12 +92,12 @@ class RandomAgent(Agent):
         """
         Check all depot locations and approach the closest one.
         """
-        print(f"Agent {self.unique_id} is seeking a depot to drop a package")
+        log.debug("Agent %s is seeking a depot to drop a package", self.unique_id)
         # Read the global dictionary with all depot pointers and obtain their positions
         agent_position = self.pos
         closest_depot = None
         for val in depots.values():
-            print(f"Depot {val.unique_id} found, packages: {val.get_packages()}/5")
+            log.debug("Depot %s found, packages: %s/5", val.unique_id, val.packages)
             if(val.available()):
                 if(closest_depot == None):
                     closest_depot = val
@@ -110,7 +113,7 @@ class RandomAgent(Agent):
                             if(self.random.random() > 0.5):
                                 closest_depot = val
             else:
-                print(f"Depot {val.unique_id} is full")
+                log.debug("Depot %s is full", val.unique_id)
             
 
         # If the agent is not in the same cell as the depot, approach it by one step
@@ -134,7 +137,7 @@ class RandomAgent(Agent):
         """
         Move the agent to a random position.
         """
-        print("(While moving randomly...)")
+        log.debug("(While moving randomly...)")
         # Get the neighbors of the agent
         content = []
         possible_steps = []
@@ -146,9 +149,9 @@ class RandomAgent(Agent):
             # if(len(content) != 0):
             #     print(f"{pos} is not empty, and contains a {content[0].type_str}")
             if(len(content) == 0):
-                print(f"{pos} is in fact empty")
+                log.debug("%s is in fact empty", pos)
                 possible_steps.append(pos)
-        print(f"Possible steps: {possible_steps}")
+        log.debug("Possible steps: %s", possible_steps)
 
         # Ensure that the agent can move
         if len(possible_steps) > 0:
@@ -156,7 +159,7 @@ class RandomAgent(Agent):
             new_position = self.random.choice(possible_steps)
         else:
             new_position = self.pos
-            print(f"Agent {self.unique_id} is stuck! :(")
+            log.debug("Agent %s is stuck! :(", self.unique_id)
 
         # Move the agent
         self.model.grid.move_agent(self, new_position)
@@ -194,11 +197,11 @@ class RandomAgent(Agent):
             new_position = self.random.choice(possible_steps)
 
             # Move the agent
-            print(f"Agent {self.unique_id} moved to {new_position}")
+            log.debug("Agent %s moved to %s", self.unique_id, new_position)
             self.model.grid.move_agent(self, new_position)
             return
         else:
-            print(f"Agent {self.unique_id} is stuck. (There is a {content[0].type_str} in the way)")
+            log.debug("Agent %s is stuck. (There is a %s in the way)", self.unique_id, content[0].type_str)
             self.random_move(self.model.grid.get_neighborhood(self.pos, moore=False, include_center=True))
             return
 
@@ -212,6 +215,8 @@ class ObstacleAgent(Agent):
     """
     Obstacle agent. Just to add obstacles to the grid.
     """
+    passive = True
+
     def __init__(self, unique_id, type_str, model):
         super().__init__(unique_id, model)
         self.type_str = type_str
@@ -223,6 +228,8 @@ class PackageAgent(Agent):
     """
     Package agent. Package can be picked up by agent and placed in a port.
     """
+    passive = True
+
     def __init__(self, unique_id, type_str, model):
         super().__init__(unique_id, model)
         self.type_str = type_str
@@ -247,6 +254,7 @@ class DepotAgent(Agent):
     """
     Depot agent. Depot can receive up to X packages, stacked on top of each other.
     """
+    passive = True
     
     def __init__(self, unique_id, type_str, model):
         super().__init__(unique_id, model)
@@ -273,9 +281,9 @@ class DepotAgent(Agent):
         Load package into depot.
         """
         self.packages += 1
-        print(f"Depot {self.unique_id} was loaded with package #{self.packages}")
+        log.debug("Depot %s was loaded with package #%s", self.unique_id, self.packages)
         if self.packages == 5:
-            print(f"Depot {self.unique_id} is now full!")
+            log.info("Depot %s is now full!", self.unique_id)
 
     
 
@@ -291,7 +299,8 @@ class RandomModel(Model):
         self.num_packages = P
         self.num_depots = D
         self.grid = Grid(width,height,torus = False) 
-        self.schedule = RandomActivation(self)
+        # Only robots are activated, the border, packages and depots are scheduled asleep
+        self.schedule = ActiveSetActivation(self)
         self.running = True
 
         # Creates the border of the grid
@@ -348,6 +357,6 @@ class RandomModel(Model):
         '''Advance the model by one step.'''
         # Check if total packages matches depot total packages
         if self.num_packages == sum([depots[i].get_packages() for i in depots]):
-            print("All packages have been delivered!")
+            log.info("All packages have been delivered!")
             self.running = False
         self.schedule.step()
@@ -0,0 +1,103 @@
+"""
+Logging for the simulation. Messages emitted every step or for every robot are logged at DEBUG, so they
+cost a single level check unless enabled. Records that pass go through a per-message rate limit and are
+queued to a background thread, which does the formatting-heavy I/O, so a slow terminal never holds up a step.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Parent of every simulation logger
+ROOT = "robots"
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets each message (logger and format string, not the formatted text) through at most rate times per
+    second, with bursts of up to burst messages. The next record that passes says how many were dropped.
+    """
+    def __init__(self, rate=10, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (logger, msg): (tokens, last refill, suppressed)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, suppressed = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records instead of blocking or raising when the queue is full.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(level=None, rate=10, burst=20, max_queued=10000, stream=None):
+    """
+    Routes the simulation loggers through the rate limit and the background queue. Called once by the
+    servers; without it only warnings and errors are printed.
+    Args:
+        level: Level name or number, defaults to the ROBOTS_LOG_LEVEL environment variable or INFO.
+            DEBUG turns on the per-step and per-robot messages
+        rate: Messages per second let through for each message
+        burst: Messages let through at once before the rate applies
+        max_queued: Records waiting for the background thread before new ones are dropped
+        stream: Where to write, stderr by default
+    """
+    global _listener
+    if level is None:
+        level = os.environ.get("ROBOTS_LOG_LEVEL", "INFO")
+
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level)
+    if _listener is not None:
+        return logger
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    records = queue.Queue(max_queued)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(rate, burst))
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    # Flush what is still queued on exit
+    atexit.register(_listener.stop)
+    return logger
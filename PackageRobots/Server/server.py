@@ -18,6 +18,7 @@ from mesa.visualization.UserParam import UserSettableParameter
 import math
 from flask import Flask, request, jsonify
 from RandomAgents import *
+from logs import configure_logging
 
 # Size of the board:
 number_agents = 10
@@ -141,4 +142,5 @@ def updateModel():
         return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
 
 if __name__=='__main__':
+    configure_logging()
     app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file